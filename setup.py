@@ -36,7 +36,7 @@ setuptools.setup(
     packages=["topasdosecalc", "topasdosecalc.src"],
     scripts=["topasdosecalc/topasdosecalc.py"],
     entry_points={
-        "console_scripts": ["topasdosecalc=topasdosecalc.topasdosecalc:topasdosecalc"],
+        "console_scripts": ["topasdosecalc=topasdosecalc.topasdosecalc:main"],
     },
     keywords=["topas", "monte-carlo", "python", "simulation", "dvh", "dicom"],
     python_requires=">=3.8",
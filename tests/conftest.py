@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+RTDOSE_STORAGE = "1.2.840.10008.5.1.4.1.1.481.2"
+RTSTRUCT_STORAGE = "1.2.840.10008.5.1.4.1.1.481.3"
+FRAME_OF_REFERENCE = "1.2.826.0.1.3680043.8.498.1"
+
+# Dose grid shared by all synthetic files: (frames, rows, columns), 2 mm voxels
+SHAPE = (16, 20, 24)
+SPACING = 2.0
+ORIGIN = (-24.0, -20.0, -16.0)
+
+
+def grid_axes():
+    """The patient coordinates (z, y, x) of the synthetic dose grid."""
+    return tuple(ORIGIN[axis] + SPACING * np.arange(SHAPE[2 - axis]) for axis in (2, 1, 0))
+
+
+def gaussian_dose(centre=(0.0, 0.0, 0.0), width=300.0, maximum=2.0):
+    """A Gaussian dose distribution in Gy centred at the patient position (x, y, z)."""
+    z, y, x = np.meshgrid(*grid_axes(), indexing="ij")
+    return maximum * np.exp(-((x - centre[0]) ** 2 + (y - centre[1]) ** 2 + (z - centre[2]) ** 2) / width)
+
+
+def new_dataset(path, sop_class):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(str(path), {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.FrameOfReferenceUID = FRAME_OF_REFERENCE
+    return ds
+
+
+def write_rtdose(path, dose, scaling=1e-5):
+    """Write a dose in Gy as a uint32 RTDOSE file on the synthetic grid."""
+    ds = new_dataset(path, RTDOSE_STORAGE)
+    ds.Modality = "RTDOSE"
+    ds.NumberOfFrames, ds.Rows, ds.Columns = dose.shape
+    ds.PixelSpacing = [SPACING, SPACING]
+    ds.ImagePositionPatient = list(ORIGIN)
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.GridFrameOffsetVector = [SPACING * i for i in range(dose.shape[0])]
+    ds.SliceThickness = SPACING
+    ds.FrameIncrementPointer = (0x3004, 0x000C)
+    ds.BitsAllocated = 32
+    ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.DoseGridScaling = scaling
+    ds.DoseUnits = "GY"
+    ds.DoseType = "PHYSICAL"
+    ds.DoseSummationType = "PLAN"
+    ds.PixelData = np.round(dose / scaling).astype(np.uint32).tobytes()
+    ds.save_as(str(path), write_like_original=False)
+    return str(path)
+
+
+def ellipse_contours(centre, radii, slices):
+    """Closed planar contours of an ellipsoid-like structure on the given z positions."""
+    contours = []
+    angles = np.linspace(0, 2 * np.pi, 40, endpoint=False)
+    for z in slices:
+        shrink = 1 - ((z - centre[2]) / (radii[2] + 1)) ** 2
+        points = np.column_stack(
+            [
+                centre[0] + radii[0] * shrink * np.cos(angles),
+                centre[1] + radii[1] * shrink * np.sin(angles),
+                np.full_like(angles, z),
+            ]
+        )
+        contour = Dataset()
+        contour.ContourGeometricType = "CLOSED_PLANAR"
+        contour.NumberOfContourPoints = len(angles)
+        contour.ContourData = [float(v) for v in points.ravel()]
+        contours.append(contour)
+    return contours
+
+
+def write_rtstruct(path, structures):
+    """Write an RTSTRUCT file with (ROI number, name, contours) structures."""
+    ds = new_dataset(path, RTSTRUCT_STORAGE)
+    ds.Modality = "RTSTRUCT"
+    ds.StructureSetROISequence = []
+    ds.ROIContourSequence = []
+    ds.RTROIObservationsSequence = []
+    for number, name, contours in structures:
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ROIName = name
+        roi.ReferencedFrameOfReferenceUID = FRAME_OF_REFERENCE
+        ds.StructureSetROISequence.append(roi)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ROIDisplayColor = [255, 0, 0]
+        roi_contour.ContourSequence = contours
+        ds.ROIContourSequence.append(roi_contour)
+        observation = Dataset()
+        observation.ObservationNumber = number
+        observation.ReferencedROINumber = number
+        observation.RTROIInterpretedType = "PTV" if name == "PTV" else "ORGAN"
+        ds.RTROIObservationsSequence.append(observation)
+    ds.save_as(str(path), write_like_original=False)
+    return str(path)
+
+
+@pytest.fixture
+def dose_files(tmp_path):
+    """Twenty control point RTDOSE files with different dose shapes and scalings."""
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(20):
+        dose = gaussian_dose(centre=(i - 10.0, 0.5 * i - 5.0, 0.0), maximum=0.1 + 0.01 * i)
+        dose *= 1 + 0.05 * rng.standard_normal(dose.shape).clip(-3, 3)
+        files.append(write_rtdose(tmp_path / f"cp_{i}.dcm", dose, scaling=1e-6 * (1 + i % 3)))
+    return files
+
+
+@pytest.fixture(scope="session")
+def plan_files(tmp_path_factory):
+    """A reference and an evaluation RTDOSE file and an RTSTRUCT file with
+    the structures PTV (1) and Body (2)."""
+    folder = tmp_path_factory.mktemp("plan")
+    rng = np.random.default_rng(1)
+    reference = gaussian_dose(centre=(1.0, -1.0, 0.0))
+    evaluation = gaussian_dose(centre=(2.0, -1.0, 0.0)) * (1 + 0.02 * rng.standard_normal(SHAPE))
+    slices = np.arange(-10.0, 12.0, SPACING)
+    rtstruct = write_rtstruct(
+        folder / "rtstruct.dcm",
+        [
+            (1, "PTV", ellipse_contours((1.0, -1.0, 0.0), (7.0, 5.0, 8.0), slices[2:-2])),
+            (2, "Body", ellipse_contours((1.0, -1.0, 0.0), (12.0, 10.0, 10.0), slices[1:-1])),
+        ],
+    )
+    return (
+        write_rtdose(folder / "reference.dcm", np.clip(reference, 0, None)),
+        write_rtdose(folder / "evaluation.dcm", np.clip(evaluation, 0, None)),
+        rtstruct,
+    )
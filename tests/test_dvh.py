@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from dicompylercore import dvhcalc
+
+from topasdosecalc.src.dvh import read_structures, calculate_dvhs, calculate_dvh_sets
+from topasdosecalc.src.mask_cache import MaskCache
+
+
+@pytest.mark.parametrize("limit", [None, 150])
+def test_bincount_dvhs_match_dicompyler(plan_files, limit):
+    _, evaluation, rtstruct_file = plan_files
+    rtstruct, structures = read_structures(rtstruct_file)
+    dvhs = calculate_dvhs(rtstruct, evaluation, structures, limit, mask_cache=MaskCache())
+    assert [dvh.name for dvh in dvhs] == ["PTV", "Body"]
+    for dvh, (roi, _, _) in zip(dvhs, structures):
+        baseline = dvhcalc.get_dvh(rtstruct_file, evaluation, roi, limit=limit)
+        np.testing.assert_allclose(dvh.bins, baseline.bins)
+        np.testing.assert_allclose(dvh.counts, baseline.counts, rtol=1e-12, atol=1e-12)
+        assert dvh.volume == pytest.approx(baseline.volume)
+        assert dvh.max == pytest.approx(baseline.max)
+        assert dvh.mean == pytest.approx(baseline.mean)
+
+
+def test_parallel_dvh_sets_match_single_dose_files(plan_files):
+    reference, evaluation, rtstruct_file = plan_files
+    rtstruct, structures = read_structures(rtstruct_file)
+    dose_files = {"TOPAS DVH": evaluation, "Reference DVH": reference}
+    sets = calculate_dvh_sets(rtstruct_file, dose_files, structures, None, workers=2)
+    for description, dose_file in dose_files.items():
+        singles = calculate_dvhs(rtstruct, dose_file, structures, None, mask_cache=MaskCache())
+        for dvh, single in zip(sets[description], singles):
+            assert dvh.name == single.name
+            assert np.array_equal(dvh.counts, single.counts)
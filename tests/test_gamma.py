@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from topasdosecalc.src.gamma import gamma, gamma_pass_rate, gamma_pass_rates, crop_dose_to_roi
+from conftest import grid_axes, gaussian_dose
+
+CRITERIA = [(3, 3), (3, 2), (2, 2), (1, 1)]
+OPTIONS = dict(lower_percent_dose_cutoff=10, max_gamma=2, quiet=True)
+
+
+@pytest.fixture(scope="module")
+def doses():
+    rng = np.random.default_rng(2)
+    reference = gaussian_dose(width=60.0)
+    evaluation = gaussian_dose(centre=(1.5, 0.0, 0.0), width=60.0) * (1 + 0.02 * rng.standard_normal(reference.shape))
+    return grid_axes(), reference, evaluation
+
+
+@pytest.mark.parametrize("criterion", [(1, 1), (2, 2), (3, 2)])
+@pytest.mark.parametrize("local_gamma", [False, True])
+def test_pass_fail_only_matches_full_gamma(doses, criterion, local_gamma):
+    axes, reference, evaluation = doses
+    full = gamma(axes, reference, axes, evaluation, *criterion, local_gamma=local_gamma, **OPTIONS)
+    pass_fail = gamma(axes, reference, axes, evaluation, *criterion, local_gamma=local_gamma, pass_fail_only=True, **OPTIONS)
+    evaluated = ~np.isnan(full)
+    assert np.array_equal(evaluated, ~np.isnan(pass_fail))
+    assert 0 < np.mean(full[evaluated] <= 1) < 1
+    assert np.array_equal(full[evaluated] <= 1, pass_fail[evaluated] == 1)
+
+
+def test_shared_search_matches_single_criteria(doses):
+    axes, reference, evaluation = doses
+    shared = gamma(axes, reference, axes, evaluation, [3, 2, 1], [3, 2, 1], **OPTIONS)
+    for (dose, distance), values in shared.items():
+        single = gamma(axes, reference, axes, evaluation, dose, distance, **OPTIONS)
+        assert np.array_equal(np.isnan(single), np.isnan(values))
+        np.testing.assert_allclose(values, single, rtol=1e-12)
+
+
+def test_multiple_criteria_pass_rates_match_single_runs(plan_files):
+    reference, evaluation, rtstruct = plan_files
+    pass_rates = gamma_pass_rates(reference, evaluation, rtstruct, 1, CRITERIA, ["Global", "Local"])
+    assert len(pass_rates) == 2 * len(CRITERIA)
+    for (dose, distance, gamma_type), pass_rate in pass_rates.items():
+        single = gamma_pass_rate(reference, evaluation, rtstruct, 1, dose, distance, local_gamma=gamma_type == "Local")
+        assert pass_rate == single
+    assert pass_rates[(1.0, 1.0, "Local")] < 1
+
+
+@pytest.mark.parametrize("roi", [1, 2])
+@pytest.mark.parametrize("local_gamma", [False, True])
+def test_float32_gives_the_float64_pass_fail_decisions(plan_files, roi, local_gamma):
+    reference, evaluation, rtstruct = plan_files
+    decisions = {}
+    for dtype in (np.float64, np.float32):
+        axes_reference, dose_reference, mask = crop_dose_to_roi(reference, rtstruct, roi, dtype=dtype, margin=2, return_mask=True)
+        axes_evaluation, dose_evaluation = crop_dose_to_roi(evaluation, rtstruct, roi, dtype=dtype, margin=2)
+        values = gamma(
+            axes_reference, dose_reference, axes_evaluation, dose_evaluation, 1, 1,
+            local_gamma=local_gamma, dtype=dtype, reference_mask=mask, **OPTIONS,
+        )
+        assert values.dtype == dtype
+        decisions[dtype] = (np.isnan(values), values <= 1)
+    assert np.array_equal(decisions[np.float64][0], decisions[np.float32][0])
+    assert np.array_equal(decisions[np.float64][1], decisions[np.float32][1])
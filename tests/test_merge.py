@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+from pydicom import dcmread
+
+from topasdosecalc import core
+from topasdosecalc.src.dicom_index import DoseIndex
+from topasdosecalc.src.merge import merge_dose, incremental_merge
+from conftest import gaussian_dose, write_rtdose
+
+
+def reference_sum(files, scales):
+    total = 0
+    for file, scale in zip(files, scales):
+        with dcmread(file) as ds:
+            total = total + scale * ds.pixel_array.astype(np.float64) * float(ds.DoseGridScaling)
+    return total
+
+
+def scales_for(files):
+    return [1.0 + 0.1 * i for i in range(len(files))]
+
+
+def test_merge_matches_direct_sum(dose_files):
+    scales = scales_for(dose_files)
+    np.testing.assert_allclose(merge_dose(dose_files, scales), reference_sum(dose_files, scales), rtol=1e-12)
+
+
+@pytest.mark.parametrize("workers", [2, 3, 4])
+def test_merge_is_identical_for_any_number_of_workers(dose_files, workers):
+    scales = scales_for(dose_files)
+    assert np.array_equal(merge_dose(dose_files, scales, workers=workers), merge_dose(dose_files, scales))
+
+
+def test_merge_without_dose_returns_none(dose_files):
+    assert merge_dose(dose_files, [0.0] * len(dose_files)) is None
+    with pytest.raises(ValueError, match="Every weight is 0"):
+        core.merge(dose_files, [0.0] * len(dose_files))
+
+
+def test_core_merge_returns_gray_when_writing(dose_files, tmp_path):
+    scales = scales_for(dose_files)
+    output = str(tmp_path / "merged.dcm")
+    data = core.merge(dose_files, scales, output=output)
+    assert np.array_equal(data, merge_dose(dose_files, scales))
+    with dcmread(output) as ds:
+        written = ds.pixel_array * float(ds.DoseGridScaling)
+    np.testing.assert_allclose(written, data, atol=float(np.max(data)) * 2.0**-31)
+
+
+def test_incremental_merge_matches_full_merge(dose_files, tmp_path):
+    state = str(tmp_path / "state")
+    scales = scales_for(dose_files)
+    progress = []
+
+    # The first run has no state and is a full merge
+    assert np.array_equal(incremental_merge(dose_files, scales, state), merge_dose(dose_files, scales))
+
+    # Unchanged inputs are not read again
+    assert np.array_equal(incremental_merge(dose_files, scales, state, progress=progress.append), merge_dose(dose_files, scales))
+    assert progress == []
+
+    # A re-simulated control point
+    write_rtdose(dose_files[5], gaussian_dose(centre=(4.0, 2.0, -3.0), maximum=0.3), scaling=3e-6)
+    os.utime(dose_files[5], ns=(0, os.stat(dose_files[5]).st_mtime_ns + 10**9))
+    np.testing.assert_allclose(incremental_merge(dose_files, scales, state), merge_dose(dose_files, scales), rtol=1e-12, atol=1e-15)
+
+    # A changed scale
+    scales[12] = 7.0
+    np.testing.assert_allclose(incremental_merge(dose_files, scales, state), merge_dose(dose_files, scales), rtol=1e-12, atol=1e-15)
+
+    # A removed control point
+    files, scales = dose_files[:-1], scales[:-1]
+    np.testing.assert_allclose(incremental_merge(files, scales, state), merge_dose(files, scales), rtol=1e-12, atol=1e-15)
+
+
+def test_index_maps_files_to_control_points(tmp_path):
+    files = [write_rtdose(tmp_path / f"Field_{field}_cp_{cp}.dcm", gaussian_dose(maximum=0.1)) for field in (1, 2) for cp in (10, 2, 1)]
+    index = DoseIndex.build(str(tmp_path), files)
+    assert [os.path.basename(header.path) for header in index.headers] == [
+        "Field_1_cp_1.dcm", "Field_1_cp_2.dcm", "Field_1_cp_10.dcm", "Field_2_cp_1.dcm", "Field_2_cp_2.dcm", "Field_2_cp_10.dcm",
+    ]
+    assert [index.control_point(header.path) for header in index.headers] == list(range(6))
+    assert [os.path.basename(header.path) for header in index.field(2)] == ["Field_2_cp_1.dcm", "Field_2_cp_2.dcm", "Field_2_cp_10.dcm"]
+    assert index.field(3) == []
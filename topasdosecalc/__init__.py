@@ -1 +1,8 @@
-from topasdosecalc import topasdosecalc
+def __getattr__(name):
+    # The entry module is only imported on first access, so that
+    # ``topasdosecalc.core`` can be used without customtkinter installed.
+    if name == "topasdosecalc":
+        from importlib import import_module
+
+        return import_module(f"{__name__}.topasdosecalc")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,187 @@
+"""Pure-Python API of TopasDoseCalc.
+
+The functions here run the merge, DVH and gamma calculations without the GUI.
+Importing this module does not load customtkinter, Pillow or matplotlib;
+heavy dependencies are only imported by the calculations that need them.
+
+Long running calculations take an optional ``progress`` callable, which is
+called with the completed fraction (0 to 1) of the current stage, and DVH
+calculations additionally take a ``log`` callable for status messages.
+
+Example
+-------
+>>> from topasdosecalc import core
+>>> files, _ = core.collect_dose_files("simulation", False, "TOPAS")
+>>> dose = core.merge(files, [1.0] * len(files), output="simulation/TOPAS.dcm")
+>>> core.gamma_pass_rate("plan_dose.dcm", "simulation/TOPAS.dcm", "rtstruct.dcm", 1, 3, 3)
+"""
+
+from .src.dose_volume import DoseVolume, read_dose_volume
+from .src.dicom_index import DoseFileHeader, DoseIndex
+from .src.merge import (
+    collect_dose_files,
+    merge_dose,
+    incremental_merge,
+    write_merged_dose,
+    merge_iso_files,
+    iso_summary,
+    write_iso_csv,
+)
+from .src.rtplan import PlanData, read_plan, mu_sequence
+from .src.dvh import read_structures, calculate_dvhs, calculate_dvh_sets
+from .src.shells import ShellCache
+from .src.mask_cache import MaskCache
+
+
+def merge(files, weights, output=None, description="TOPAS", template=None, state_dir=None, progress=None, workers=1):
+    """Sum the weighted dose of several RTDOSE files.
+
+    Parameters
+    ----------
+    files : list
+        Paths or DoseFileHeader index entries of the RTDOSE files, in control
+        point order.
+    weights : list
+        Scale factor of each file. The merged dose is
+        ``sum(weight * stored value * DoseGridScaling)``.
+    output : str, optional
+        If given, the merged dose is also written to this RTDOSE file.
+    description : str, optional
+        SeriesDescription of the written file.
+    template : str, optional
+        RTDOSE file whose header is used for the output. Defaults to the last
+        file.
+    state_dir : str, optional
+        If given, the merge is incremental: the state is kept in this folder
+        and only files that changed since the last run are re-read.
+    progress : callable, optional
+        Called with the completed fraction of the merge.
+    workers : int, optional
+        Number of worker processes.
+
+    Returns
+    -------
+    np.ndarray
+        The merged dose volume in Gy.
+    """
+    if len(files) != len(weights):
+        raise ValueError(f"Got {len(files)} dose files but {len(weights)} weights")
+    if state_dir is not None:
+        headers = [file if isinstance(file, DoseFileHeader) else DoseFileHeader.read(file) for file in files]
+        data = incremental_merge(headers, weights, state_dir, progress=progress, workers=workers)
+    else:
+        data = merge_dose(files, weights, progress=progress, workers=workers)
+    if data is None:
+        raise ValueError("Every weight is 0, there is no dose to merge")
+    if output is not None:
+        if template is None:
+            template = files[-1].path if isinstance(files[-1], DoseFileHeader) else files[-1]
+        write_merged_dose(template, data.copy(), output, description)
+    return data
+
+
+def dvh(rtstruct_file, dose_file, rois=None, limit=None, progress=None, log=None):
+    """Calculate cumulative DVHs of structures in an RTDOSE file.
+
+    Parameters
+    ----------
+    rtstruct_file : str
+        Path of the RTSTRUCT file.
+    dose_file : str
+        Path of the RTDOSE file.
+    rois : list, optional
+        ROI numbers or names to calculate. Defaults to all structures.
+    limit : int, optional
+        Dose limit in cGy.
+    progress : callable, optional
+        Called with the completed fraction after each structure.
+    log : callable, optional
+        Called with a status message before each structure.
+
+    Returns
+    -------
+    dict
+        The DVH of each structure, keyed by ROI name.
+    """
+    rtstruct, structures = read_structures(rtstruct_file)
+    if rois is not None:
+        selected = [structure for structure in structures if structure[0] in rois or structure[1] in rois]
+        missing = set(rois) - {structure[0] for structure in selected} - {structure[1] for structure in selected}
+        if missing:
+            raise ValueError(f"Structures not found in RTSTRUCT: {', '.join(str(roi) for roi in missing)}")
+        structures = selected
+    dvhs = calculate_dvhs(rtstruct, dose_file, structures, limit, progress=progress, log=log)
+    return {structure[1]: result for structure, result in zip(structures, dvhs)}
+
+
+def gamma_pass_rate(
+    reference_file,
+    evaluation_file,
+    rtstruct_file,
+    roi_number,
+    dose_percent_threshold,
+    distance_mm_threshold,
+    lower_percent_dose_cutoff=10,
+    local_gamma=False,
+    progress=None,
+    **kwargs,
+):
+    """Return the gamma pass rate of an evaluated RTDOSE file against a
+    reference inside one structure.
+
+    Further keyword arguments (``interp_fraction``, ``max_gamma``,
+    ``ram_available``, ``shell_cache``, ``mask_cache``, ``workers``,
+    ``pass_fail_only``, ``dtype``) are passed on to the gamma calculation.
+    As in :func:`gamma_pass_rates`, ``pass_fail_only`` defaults to None,
+    which only computes the pass/fail decision for this single criterion.
+    """
+    from .src.gamma import gamma_pass_rate as _gamma_pass_rate
+
+    return _gamma_pass_rate(
+        reference_file,
+        evaluation_file,
+        rtstruct_file,
+        roi_number,
+        dose_percent_threshold,
+        distance_mm_threshold,
+        lower_percent_dose_cutoff=lower_percent_dose_cutoff,
+        local_gamma=local_gamma,
+        progress=progress,
+        **kwargs,
+    )
+
+
+def gamma_pass_rates(
+    reference_file,
+    evaluation_file,
+    rtstruct_file,
+    roi_number,
+    criteria,
+    gamma_types=("Global",),
+    lower_percent_dose_cutoff=10,
+    progress=None,
+    **kwargs,
+):
+    """Return the gamma pass rates of several criteria, keyed by
+    (dose percent, distance mm, gamma type).
+
+    ``criteria`` is a list of (dose percent, distance mm) tuples and
+    ``gamma_types`` holds ``"Global"`` and/or ``"Local"``. Every combination
+    with the same distance is calculated from one shared gamma search.
+    Further keyword arguments are those of :func:`gamma_pass_rate`,
+    including ``pass_fail_only``, which defaults to None: only the pass/fail
+    decision is computed for a single criterion and type.
+    """
+    from .src.gamma import gamma_pass_rates as _gamma_pass_rates
+
+    return _gamma_pass_rates(
+        reference_file,
+        evaluation_file,
+        rtstruct_file,
+        roi_number,
+        criteria,
+        gamma_types,
+        lower_percent_dose_cutoff=lower_percent_dose_cutoff,
+        progress=progress,
+        **kwargs,
+    )
@@ -0,0 +1,95 @@
+import customtkinter as ctk
+import os
+import sys
+import threading
+from queue import SimpleQueue, Empty
+from datetime import datetime
+
+from .options import Options
+from .progress import ProgressChannel, TkProgress
+
+class topasdosecalc(ctk.CTk):
+    def __init__(self):
+        super().__init__()
+        ctk.set_appearance_mode("dark")
+        ctk.set_default_color_theme("blue")
+        
+        self.appname = "TopasDoseCalc"
+        self.version = "2.0.0"
+        self.author = "Sebastian Schäfer"
+        self.title(f"{self.appname} - v.{self.version}")
+        
+        self.minsize(width=960, height=500)
+        self.geometry("960x500")
+        self.resizable(False, False)
+        self.iconpath = self.resource_path(os.path.join("src", "images", "icon.ico"))
+        self.iconbitmap(self.iconpath)
+        
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, minsize=480)
+        self.columnconfigure(1, minsize=480)
+        self.rowconfigure(1, minsize=12)
+        
+        # Worker threads never touch widgets. Log messages and progress go
+        # through a rate-limited channel, other calls are posted and run by
+        # the main loop when it handles <<WorkerUpdate>>.
+        self.updates = SimpleQueue()
+        self.bind("<<WorkerUpdate>>", self.process_updates)
+        self.pbvar=ctk.DoubleVar(value=0)
+        self.channel = ProgressChannel()
+        self.progress_consumer = TkProgress(self, self.channel, self.pbvar.set, self.write_log)
+        
+        self.options = Options(self)
+        self.options.grid(row=0, column=0, sticky="nsew", padx=2, pady=2)
+        self.logger = ctk.CTkTextbox(self, activate_scrollbars=True, state="disabled", border_color="black", border_width=1, font=("Bahnschrift",14), fg_color="#2B2B2B", tabs="1.5c", wrap="none")
+        self.init_logger()
+        self.logger.grid(row=0, column=1, sticky="nsew", padx=2)
+        self.pb = ctk.CTkProgressBar(self, progress_color="green", corner_radius=0, variable = self.pbvar)
+        self.pb.grid(row=1, columnspan=2, column=0, sticky="nsew", pady=(2,0))
+
+        self.mainloop()
+            
+    def resource_path(self, relative_path):
+        """ Get absolute path to resource, works for dev and for PyInstaller """
+        if hasattr(sys, '_MEIPASS'):
+            return os.path.join(sys._MEIPASS, "topasdosecalc", relative_path)
+        return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), relative_path)
+    
+    def init_logger(self):
+        self.log(f"{self.appname} v.{self.version} - by {self.author}", logtime = False)
+        self.log("_______________________________________________\n", logtime = False)
+        self.log("Initialized")
+    
+    def post(self, function, *args):
+        """Run ``function(*args)`` on the main loop. Safe to call from any thread."""
+        self.updates.put((function, args))
+        self.event_generate("<<WorkerUpdate>>", when="tail")
+        
+    def process_updates(self, event=None):
+        while True:
+            try:
+                function, args = self.updates.get_nowait()
+            except Empty:
+                return
+            function(*args)
+    
+    def on_main_thread(self):
+        return threading.current_thread() is threading.main_thread()
+    
+    def progress(self, fraction):
+        self.channel.progress(fraction)
+    
+    def log(self, message, logtime=True):
+        if self.on_main_thread():
+            self.write_log(datetime.now(), message, logtime)
+        else:
+            self.channel.log(message, logtime)
+    
+    def write_log(self, moment, message, logtime=True):
+        time = ""
+        if logtime:
+            time = moment.strftime("%H:%M:%S") + "\t| "
+        self.logger.configure(state="normal")
+        self.logger.insert("end", f"{time}{message}\n")
+        self.logger.configure(state="disabled")
+        self.logger.see("end")
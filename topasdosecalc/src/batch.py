@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+from natsort import natsorted
+
+from .merge import collect_dose_files, merge_dose, incremental_merge, write_merged_dose, merge_iso_files, iso_summary, write_iso_csv
+from .dicom_index import DoseIndex
+from .rtplan import read_plan, mu_sequence
+from .dvh import DVH_WORKERS, read_structures, calculate_dvh_sets, plot_dvhs
+from .mask_cache import MaskCache
+from .progress import JsonLinesLog
+
+JOB_DEFAULTS = {
+    "include_subdirectories": False,
+    "description": "TOPAS",
+    "mus": None,
+    "reference": {"mus": 100, "histories": 500000000, "scale": 973375},
+    "rtplan": None,
+    "interpolate": False,
+    "merge_iso": False,
+    "incremental": False,
+    "workers": 1,
+    "dvh_workers": DVH_WORKERS,
+    "rtstruct": None,
+    "rtdose": None,
+    "prescription": None,
+    "dvh": [],
+    "gamma": None,
+    "shell_cache": None,
+    "mask_cache": None,
+}
+
+GAMMA_DEFAULTS = {
+    "criteria": None,
+    "dose_percent": 2,
+    "distance_mm": 3,
+    "lower_percent_dose_cutoff": 10,
+    "type": "Global",
+    "workers": 1,
+    "dtype": "float64",
+}
+
+PATH_KEYS = ("folder", "rtplan", "rtstruct", "rtdose", "shell_cache", "mask_cache")
+
+
+def log(message, logtime=True):
+    time = ""
+    if logtime:
+        time = datetime.now().strftime("%H:%M:%S") + "\t| "
+    print(f"{time}{message}", flush=True)
+
+
+def load_jobs(path):
+    """Read a job file containing a single job or a list of jobs.
+
+    Relative paths in the jobs are resolved against the directory of the job
+    file, and missing keys are filled in from ``JOB_DEFAULTS``.
+    """
+    with open(path, "r") as file:
+        content = json.load(file)
+    if isinstance(content, dict):
+        content = [content]
+
+    jobs = []
+    base = os.path.dirname(os.path.abspath(path))
+    for entry in content:
+        job = dict(JOB_DEFAULTS, **entry)
+        job["reference"] = dict(JOB_DEFAULTS["reference"], **entry.get("reference", {}))
+        if "folder" not in entry or "histories" not in entry:
+            raise ValueError(f"Every job in {path} needs a 'folder' and 'histories'")
+        for key in PATH_KEYS:
+            if job[key] is not None:
+                job[key] = os.path.join(base, job[key])
+        jobs.append(job)
+    return jobs
+
+
+def run_job(job, log=log, progress=None):
+    """Run the merge -> DVH -> gamma pipeline for one job.
+
+    ``log`` is called with status messages and ``progress``, if given, with
+    the completed fraction of each stage.
+
+    Returns
+    -------
+    dict
+        The paths of the written files and the computed results.
+    """
+    folder = job["folder"]
+    description = job["description"].strip()
+    output = os.path.join(folder, f"{description}.dcm")
+    results = {"folder": folder, "output": output}
+
+    files, iso_files = collect_dose_files(folder, job["include_subdirectories"], description)
+    if len(files) == 0:
+        raise ValueError(f"No dose files found in {folder}")
+    log(f"Found {len(files)} dose files in {folder}")
+    index = DoseIndex.build(folder, files, progress=progress)
+    index.check_grids()
+
+    fractions = 1
+    sequence = None
+    prescription = job["prescription"]
+    if job["rtplan"] is not None:
+        log(f"Loading MU sequence from {job['rtplan']}")
+        plan = read_plan(job["rtplan"])
+        sequence = mu_sequence(plan.cumulative_mu, job["interpolate"])
+        fractions = plan.fractions
+        if prescription is None:
+            prescription = plan.dose
+        log(f"Prescription: {fractions} x {round(plan.dose,2)} Gy")
+        log(f"Number of control points: {len(sequence)}")
+
+    reference = job["reference"]
+    scale = float(reference["scale"]) * (float(reference["histories"]) / float(job["histories"])) * fractions
+    if job["mus"] is not None:
+        scales = [scale * float(job["mus"]) / float(reference["mus"])] * len(files)
+    elif sequence is not None:
+        if len(sequence) != len(files):
+            raise ValueError(f"Number of dose files ({len(files)}) does not match number of control points ({len(sequence)})")
+        scales = [scale * float(sequence[index.control_point(header.path)]) / float(reference["mus"]) for header in index.headers]
+    else:
+        raise ValueError("Either 'mus' or 'rtplan' is required to scale the dose")
+
+    log("Merging dose files...")
+    if job["incremental"]:
+        data = incremental_merge(index.headers, scales, os.path.join(folder, f"{description}_merge"), progress=progress, workers=job["workers"])
+    else:
+        data = merge_dose(index.headers, scales, progress=progress, workers=job["workers"])
+    if data is None:
+        raise ValueError("Every weight is 0, there is no dose to merge")
+    write_merged_dose(index.headers[-1].path, data, output, description)
+    del data
+    log(f"Saved merged dose file to {output}")
+
+    if job["merge_iso"]:
+        if sequence is None or len(iso_files) != len(sequence):
+            log("Skipping isocenter merge: number of isocenter files does not match number of control points")
+        else:
+            log("Merging isocenter data...")
+            iso_scale = float(reference["scale"]) * (float(reference["histories"]) / float(job["histories"])) / float(reference["mus"])
+            data = merge_iso_files(natsorted(iso_files), [iso_scale * float(mu) for mu in sequence], progress=progress)
+            dose_to_isocenter, statistical_accuracy, average_counts = iso_summary(data)
+            iso_output = os.path.join(folder, f"{description}_iso.csv")
+            write_iso_csv(iso_output, data)
+            results["isocenter"] = {
+                "dose": float(dose_to_isocenter * fractions),
+                "statistical_accuracy": float(statistical_accuracy),
+                "average_counts": float(average_counts),
+                "output": iso_output,
+            }
+            log(f"Dose to reference point: {round(dose_to_isocenter*fractions,2)} Gy")
+            log(f"Statistical accuracy: {round(100*statistical_accuracy,2)}%")
+
+    if job["dvh"] or job["gamma"]:
+        if job["rtstruct"] is None:
+            raise ValueError("DVH and gamma calculations need an 'rtstruct'")
+        rtstruct, structures = read_structures(job["rtstruct"])
+        mask_cache = None if job["mask_cache"] is None else MaskCache(directory=job["mask_cache"])
+
+    if job["dvh"]:
+        if job["rtdose"] is None or prescription is None:
+            raise ValueError("DVH calculations need an 'rtdose' and an 'rtplan' or 'prescription'")
+        selected = select_structures(structures, job["dvh"])
+        limit = int(fractions*prescription*110)
+        dvhs = calculate_dvh_sets(
+            job["rtstruct"],
+            {"TOPAS DVH": output, "Reference DVH": job["rtdose"]},
+            selected,
+            limit,
+            workers=job["dvh_workers"],
+            progress=progress,
+            log=log,
+            mask_cache=mask_cache,
+        )
+        topas_dvh, ref_dvh = dvhs["TOPAS DVH"], dvhs["Reference DVH"]
+        dvh_output = os.path.join(folder, f"{description}.png")
+        plot_dvhs(topas_dvh, ref_dvh, structures, fractions*prescription*1.1, dvh_output)
+        results["dvh"] = dvh_output
+        log(f"Saved DVHs to {dvh_output}")
+
+    if job["gamma"]:
+        if job["rtdose"] is None:
+            raise ValueError("Gamma calculations need an 'rtdose'")
+        from .gamma import gamma_pass_rates
+        from .shells import ShellCache
+
+        if job["gamma"].get("criteria") is not None and ("dose_percent" in job["gamma"] or "distance_mm" in job["gamma"]):
+            raise ValueError("Give the gamma 'criteria' or 'dose_percent' and 'distance_mm', not both")
+        criteria = dict(GAMMA_DEFAULTS, **job["gamma"])
+        roi = select_structures(structures, [criteria["roi"]])[0]
+        gamma_criteria = gamma_criteria_list(criteria)
+        gamma_types = ["Global", "Local"] if criteria["type"].lower() in ("both", "global + local") else [criteria["type"]]
+        log(f"Calculating {', '.join(f'{d:g}%/{a:g}mm' for d, a in gamma_criteria)} Gamma Passrates for structure {roi[1]} ...")
+        pass_ratios = gamma_pass_rates(
+            job["rtdose"],
+            output,
+            job["rtstruct"],
+            int(roi[0]),
+            gamma_criteria,
+            gamma_types,
+            lower_percent_dose_cutoff=criteria["lower_percent_dose_cutoff"],
+            progress=progress,
+            workers=criteria["workers"],
+            dtype=criteria["dtype"],
+            shell_cache=None if job["shell_cache"] is None else ShellCache(directory=job["shell_cache"]),
+            mask_cache=mask_cache,
+        )
+        if criteria["criteria"] is not None:
+            del criteria["dose_percent"], criteria["distance_mm"]
+        results["gamma"] = dict(
+            criteria,
+            roi=roi[1],
+            pass_rates=[
+                {"dose_percent": dose, "distance_mm": distance, "type": gamma_type, "pass_rate": float(pass_ratio)}
+                for (dose, distance, gamma_type), pass_ratio in pass_ratios.items()
+            ],
+        )
+        for (dose, distance, gamma_type), pass_ratio in pass_ratios.items():
+            log(f"{gamma_type} {dose:g}%/{distance:g}mm Gamma Passrate: {round(pass_ratio*100,2)} %")
+
+    return results
+
+
+def gamma_criteria_list(criteria):
+    """Return the (dose percent, distance mm) criteria of a gamma job.
+
+    ``criteria`` may be a string like ``"3/3, 2/2"`` or a list of ``"3/3"``
+    strings or ``[3, 3]`` pairs. Without it, ``dose_percent`` and
+    ``distance_mm`` give a single criterion.
+    """
+    from .gamma import parse_criteria
+
+    if criteria["criteria"] is None:
+        return [(float(criteria["dose_percent"]), float(criteria["distance_mm"]))]
+    if isinstance(criteria["criteria"], str):
+        return parse_criteria(criteria["criteria"])
+    return [
+        parse_criteria(item)[0] if isinstance(item, str) else (float(item[0]), float(item[1]))
+        for item in criteria["criteria"]
+    ]
+
+
+def select_structures(structures, names):
+    """Return the structures with the given names, or all for ``True``."""
+    if names is True:
+        return structures
+    by_name = {structure[1]: structure for structure in structures}
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise ValueError(f"Structures not found in RTSTRUCT: {', '.join(missing)}")
+    return [by_name[name] for name in names]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="topasdosecalc batch",
+        description="Merge, scale and evaluate TOPAS simulations without the GUI.",
+    )
+    parser.add_argument("jobs", nargs="+", help="JSON job files, each holding one job or a list of jobs")
+    parser.add_argument("--results", help="write the results of all jobs to this JSON file")
+    parser.add_argument("--progress-log", help="append log messages and progress to this JSON lines file")
+    args = parser.parse_args(argv)
+
+    job_log, progress = log, None
+    if args.progress_log:
+        structured = JsonLinesLog(args.progress_log)
+        progress = structured.progress
+
+        def job_log(message, logtime=True):
+            log(message, logtime)
+            structured.log(message, logtime)
+
+    results = []
+    failed = 0
+    try:
+        for path in args.jobs:
+            for job in load_jobs(path):
+                job_log(f"Starting job for {job['folder']}")
+                try:
+                    results.append(run_job(job, log=job_log, progress=progress))
+                except Exception as e:
+                    failed += 1
+                    job_log(f"(ERROR) {e}")
+                    results.append({"folder": job["folder"], "error": str(e)})
+    finally:
+        if args.progress_log:
+            structured.close()
+
+    if args.results:
+        with open(args.results, "w") as file:
+            json.dump(results, file, indent=2)
+    log(f"Completed {len(results) - failed} of {len(results)} jobs")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import os
+import re
+import json
+from collections import Counter
+import numpy as np
+from dataclasses import dataclass, asdict
+from typing import Optional
+from natsort import natsorted
+from .dose_volume import DoseVolume, read_dose_header, pixel_layout, load_pixels
+
+INDEX_FILENAME = ".topasdosecalc_index.json"
+INDEX_VERSION = 1
+FIELD_PATTERN = re.compile(r"Field_(\d+)(?!\d)")
+
+
+@dataclass(frozen=True)
+class DoseFileHeader:
+    """Everything the merge needs to know about an RTDOSE file, taken from
+    its header alone."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    sop_instance_uid: str
+    shape: tuple
+    dtype: str
+    position: tuple
+    spacing: tuple
+    orientation: tuple
+    frame_offsets: tuple
+    scaling: float
+    pixel_offset: Optional[int]
+
+    @classmethod
+    def read(cls, path):
+        stat = os.stat(path)
+        ds, offset = read_dose_header(path)
+        shape, dtype = pixel_layout(ds)
+        return cls(
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            sop_instance_uid=str(ds.SOPInstanceUID),
+            shape=shape,
+            dtype=dtype.str,
+            position=tuple(float(v) for v in ds.ImagePositionPatient),
+            spacing=tuple(float(v) for v in ds.PixelSpacing),
+            orientation=tuple(float(v) for v in getattr(ds, "ImageOrientationPatient", (1, 0, 0, 0, 1, 0))),
+            frame_offsets=tuple(float(v) for v in getattr(ds, "GridFrameOffsetVector", [0.0])),
+            scaling=float(ds.DoseGridScaling),
+            pixel_offset=offset,
+        )
+
+    @classmethod
+    def from_json(cls, entry):
+        entry = dict(entry)
+        for key in ("shape", "position", "spacing", "orientation", "frame_offsets"):
+            entry[key] = tuple(entry[key])
+        return cls(**entry)
+
+    @property
+    def grid(self):
+        """The part of the header that has to agree between summed files."""
+        return (self.shape, self.position, self.spacing, self.orientation, self.frame_offsets)
+
+    def is_current(self):
+        """Whether the file on disk still has the size and mtime of this entry."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def open(self):
+        """Open the file as a DoseVolume without parsing its header again."""
+        return DoseVolume(
+            pixels=load_pixels(self.path, self.shape, np.dtype(self.dtype), self.pixel_offset),
+            scaling=self.scaling,
+            position=self.position,
+            spacing=self.spacing,
+            orientation=self.orientation,
+            frame_offsets=np.array(self.frame_offsets),
+            path=self.path,
+            pixel_offset=self.pixel_offset,
+        )
+
+
+class DoseIndex:
+    """Header index of the RTDOSE files in a merge folder.
+
+    The index is persisted in a sidecar file inside the folder, and entries
+    whose file size and mtime are unchanged are reused on the next run
+    instead of being parsed again. The control point of a file is its
+    position in natural sort order, and files named ``Field_<number>`` are
+    grouped by field; both are looked up in constant time.
+    """
+
+    def __init__(self, folder, headers):
+        self.folder = folder
+        self.headers = natsorted(headers, key=lambda header: header.path)
+        self.control_points = {header.path: i for i, header in enumerate(self.headers)}
+        self.fields = {}
+        for header in self.headers:
+            match = FIELD_PATTERN.search(os.path.basename(header.path))
+            if match is not None:
+                self.fields.setdefault(int(match.group(1)), []).append(header)
+
+    @classmethod
+    def build(cls, folder, files, progress=None):
+        cached = cls.load_cache(folder)
+        headers = []
+        for i, file in enumerate(files):
+            if progress is not None:
+                progress((i + 1) / len(files))
+            header = cached.get(os.path.relpath(file, folder))
+            if header is None or header.path != file or not header.is_current():
+                header = DoseFileHeader.read(file)
+            headers.append(header)
+        index = cls(folder, headers)
+        index.save_cache()
+        return index
+
+    @staticmethod
+    def load_cache(folder):
+        try:
+            with open(os.path.join(folder, INDEX_FILENAME), "r") as file:
+                content = json.load(file)
+            if content.get("version") != INDEX_VERSION:
+                return {}
+            return {key: DoseFileHeader.from_json(entry) for key, entry in content["files"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def save_cache(self):
+        content = {
+            "version": INDEX_VERSION,
+            "files": {os.path.relpath(header.path, self.folder): asdict(header) for header in self.headers},
+        }
+        try:
+            with open(os.path.join(self.folder, INDEX_FILENAME), "w") as file:
+                json.dump(content, file)
+        except OSError:
+            pass
+
+    @property
+    def files(self):
+        return [header.path for header in self.headers]
+
+    def check_grids(self):
+        """Raise a ValueError if the files do not share a single dose grid."""
+        if not self.headers:
+            return
+        grids = Counter(header.grid for header in self.headers)
+        reference = next(header for header in self.headers if header.grid == grids.most_common(1)[0][0])
+        mismatched = [header.path for header in self.headers if header.grid != reference.grid]
+        if mismatched:
+            raise ValueError(
+                f"{len(mismatched)} dose file(s) do not match the grid of {os.path.basename(reference.path)}: "
+                + ", ".join(os.path.basename(path) for path in mismatched[:5])
+                + (" ..." if len(mismatched) > 5 else "")
+            )
+
+    def control_point(self, path):
+        """Return the control point number of a file."""
+        return self.control_points[path]
+
+    def field(self, number):
+        """Return the headers of all files belonging to ``Field_<number>``."""
+        return self.fields.get(number, [])
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class DiskCache:
+    """Thread-safe LRU cache of read-only arrays, optionally kept on disk.
+
+    Values are created by a callable on a miss. If ``directory`` is given,
+    they are also written there and read back instead of being created
+    again, e.g. by later runs. Subclasses define the file name of a key and
+    how a value is read from and written to its file.
+    """
+
+    def __init__(self, maxsize, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, create):
+        """Return the value for ``key`` as a read-only array, calling
+        ``create()`` to make it if it is neither in memory nor on disk."""
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self.load(key)
+        if value is None:
+            value = create()
+            self.save(key, value)
+        value.flags.writeable = False
+
+        with self.lock:
+            self.misses += 1
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def filename(self, key):
+        raise NotImplementedError
+
+    def read(self, path, key):
+        """Read the value of ``key`` from ``path``. Returns None if the file
+        does not hold a valid value."""
+        raise NotImplementedError
+
+    def write(self, file, value):
+        raise NotImplementedError
+
+    def path(self, key):
+        return os.path.join(self.directory, self.filename(key))
+
+    def load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            return self.read(self.path(key), key)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, key, value):
+        if self.directory is None:
+            return
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, "wb") as file:
+                self.write(file, value)
+            os.replace(temp, path)
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
@@ -0,0 +1,154 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Any, Optional
+from pydicom import dcmread
+from pydicom.tag import Tag
+
+PIXEL_DATA = Tag(0x7FE0, 0x0010)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+@dataclass(frozen=True)
+class DoseVolume:
+    """Stored dose values of an RTDOSE file together with its grid geometry.
+
+    ``pixels`` holds the raw stored values with shape (frames, rows, columns).
+    For uncompressed files it is a read-only ``np.memmap`` of the PixelData
+    payload, so slicing it reads straight from the page cache without copies.
+    Multiply by ``scaling`` to obtain the dose in Gy.
+    """
+
+    pixels: Any
+    scaling: float
+    position: tuple
+    spacing: tuple
+    orientation: tuple
+    frame_offsets: Any
+    path: str = ""
+    pixel_offset: Optional[int] = None
+
+    @property
+    def shape(self):
+        return self.pixels.shape
+
+    @property
+    def lut(self):
+        """Patient coordinates of the columns (x) and rows (y), as in dicompyler."""
+        x = self.position[0] + self.orientation[0] * self.spacing[1] * np.arange(self.shape[2])
+        y = self.position[1] + self.orientation[4] * self.spacing[0] * np.arange(self.shape[1])
+        return x, y
+
+    @property
+    def z(self):
+        """Patient z coordinate of every frame."""
+        return self.orientation[0] * np.asarray(self.frame_offsets, dtype=float) + self.position[2]
+
+    def dose(self):
+        """Return the full dose volume in Gy as a new float64 array."""
+        return np.multiply(self.pixels, self.scaling, dtype=np.float64)
+
+    def plane(self, z, threshold=0.5):
+        """Return the stored values of the plane at z.
+
+        Mirrors ``dicomparser.GetDoseGrid``: the closest frame within
+        ``threshold`` mm is returned directly, planes between two frames are
+        linearly interpolated and planes outside the grid give an empty array.
+        """
+        planes = self.z
+        distance = np.fabs(planes - float(z))
+        if np.amin(distance) < threshold:
+            return self.pixels[np.argmin(distance)]
+        if z < np.amin(planes) or z > np.amax(planes):
+            return np.array([])
+        ub = np.argmin(distance)
+        lower = distance.copy()
+        lower[ub] = np.amax(distance)
+        lb = np.argmin(lower)
+        fz = (z - planes[lb]) / (planes[ub] - planes[lb])
+        return fz * self.pixels[ub] + (1.0 - fz) * self.pixels[lb]
+
+
+def read_dose_volume(path):
+    """Read an RTDOSE file as a DoseVolume.
+
+    Only the header is parsed. For uncompressed transfer syntaxes the offset
+    of the PixelData payload is located once and the payload is memory-mapped
+    directly; other files fall back to decoding ``pixel_array``.
+    """
+    ds, offset = read_dose_header(path)
+    shape, dtype = pixel_layout(ds)
+    return volume_from_header(ds, load_pixels(path, shape, dtype, offset), path, offset)
+
+
+def read_dose_header(path):
+    """Parse the header of an RTDOSE file without its pixels.
+
+    Returns the dataset and the file offset of the PixelData value, which is
+    None if the payload cannot be memory-mapped.
+    """
+    with open(path, "rb") as fp:
+        ds = dcmread(fp, stop_before_pixels=True)
+        return ds, _pixel_data_offset(fp, ds)
+
+
+def pixel_layout(ds):
+    """Return the (frames, rows, columns) shape and dtype of the stored values."""
+    frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    dtype = np.dtype(f"{'i' if ds.PixelRepresentation else 'u'}{int(ds.BitsAllocated) // 8}")
+    dtype = dtype.newbyteorder("<" if ds.file_meta.TransferSyntaxUID.is_little_endian else ">")
+    return (frames, int(ds.Rows), int(ds.Columns)), dtype
+
+
+def load_pixels(path, shape, dtype, offset=None):
+    """Memory-map the stored values at ``offset``, or decode them if None."""
+    if offset is not None:
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=tuple(shape))
+    return dcmread(path).pixel_array.reshape(shape)
+
+
+def volume_from_header(ds, pixels, path="", pixel_offset=None):
+    """Combine an RTDOSE header with its stored values."""
+    return DoseVolume(
+        pixels=pixels,
+        scaling=float(ds.DoseGridScaling),
+        position=tuple(float(v) for v in ds.ImagePositionPatient),
+        spacing=tuple(float(v) for v in ds.PixelSpacing),
+        orientation=tuple(float(v) for v in getattr(ds, "ImageOrientationPatient", (1, 0, 0, 0, 1, 0))),
+        frame_offsets=np.array(getattr(ds, "GridFrameOffsetVector", [0.0]), dtype=float),
+        path=str(path),
+        pixel_offset=pixel_offset,
+    )
+
+
+def _pixel_data_offset(fp, ds):
+    """Return the file offset of the PixelData value, or None if it cannot be
+    memory-mapped. ``fp`` must be positioned where ``stop_before_pixels``
+    stopped, i.e. at the PixelData tag."""
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if transfer_syntax.is_compressed:
+        return None
+    byteorder = "little" if transfer_syntax.is_little_endian else "big"
+    start = fp.tell()
+    header = fp.read(12)
+    if len(header) < 8:
+        return None
+    group = int.from_bytes(header[0:2], byteorder)
+    element = int.from_bytes(header[2:4], byteorder)
+    if Tag(group, element) != PIXEL_DATA:
+        return None
+    if transfer_syntax.is_implicit_VR:
+        length = int.from_bytes(header[4:8], byteorder)
+        value_offset = start + 8
+    elif header[4:6] in (b"OB", b"OW", b"OF", b"OD", b"OL", b"UN"):
+        length = int.from_bytes(header[8:12], byteorder)
+        value_offset = start + 12
+    else:
+        return None
+    if length == UNDEFINED_LENGTH:
+        return None
+
+    frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+    expected = frames * int(ds.Rows) * int(ds.Columns) * (int(ds.BitsAllocated) // 8)
+    if int(ds.BitsAllocated) % 8 or length < expected:
+        return None
+    return value_offset
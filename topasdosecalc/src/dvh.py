@@ -0,0 +1,372 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, replace
+from typing import Any, Optional
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+from .dose_volume import read_dose_volume
+from .rasterize import contours_mask, structure_bounding_box
+from .mask_cache import MASK_CACHE, MaskCache
+
+# Default number of DVH worker processes
+DVH_WORKERS = max(2, os.cpu_count() or 1)
+
+
+def read_structures(rtstruct_file):
+    """Read the structures of an RTSTRUCT file.
+
+    Returns
+    -------
+    tuple
+        The RTSTRUCT dataset and a list of (ROI number, name, hex colour)
+        tuples sorted by ROI number.
+    """
+    structures = []
+    with dcmread(rtstruct_file) as dcmfile:
+        for i in range(len(dcmfile.StructureSetROISequence)):
+            structures += [
+                (
+                    dcmfile.StructureSetROISequence[i].ROINumber,
+                    dcmfile.StructureSetROISequence[i].ROIName,
+                    "#"+"".join([format(c,'02x') for c in [dcmfile.ROIContourSequence[j].ROIDisplayColor for j in range(len(dcmfile.ROIContourSequence)) if dcmfile.ROIContourSequence[j].ReferencedROINumber == dcmfile.StructureSetROISequence[i].ROINumber][0]]),
+                )
+            ]
+    structures.sort(key=lambda y: y[0])
+    return dcmfile, structures
+
+
+@dataclass(frozen=True)
+class DVH:
+    """Cumulative dose volume histogram with 1 cGy bins.
+
+    ``counts`` holds the volume receiving at least the lower edge of each
+    dose bin, ``bins`` the bin edges. The attributes used by the plots match
+    those of ``dicompylercore.dvh.DVH``.
+    """
+
+    name: str
+    counts: Any
+    bins: Any
+    dose_units: str = "Gy"
+    volume_units: str = "cm3"
+    notes: Optional[str] = None
+
+    @property
+    def bincenters(self):
+        return 0.5 * (self.bins[1:] + self.bins[:-1])
+
+    @property
+    def differential(self):
+        """The volume in each dose bin."""
+        return np.abs(np.diff(np.append(self.counts, 0)))
+
+    @property
+    def volume(self):
+        return self.differential.sum()
+
+    @property
+    def relative_volume(self):
+        """The DVH with the volume in percent of the structure volume."""
+        if self.volume_units == "%":
+            return self
+        maximum = self.counts.max() if self.counts.size and self.counts.max() > 0 else 1
+        return replace(self, counts=100 * self.counts / maximum, volume_units="%")
+
+    @property
+    def max(self):
+        differential = self.differential
+        if not differential.any():
+            return 0
+        return self.bins[1:][differential > 0][-1]
+
+    @property
+    def min(self):
+        differential = self.differential
+        if not differential.any():
+            return 0
+        return self.bins[:-1][differential > 0][0]
+
+    @property
+    def mean(self):
+        differential = self.differential
+        if not differential.any():
+            return 0
+        return (self.bincenters * differential).sum() / differential.sum()
+
+
+def structure_planes(rtstruct, roi_number):
+    """Return the contours of a structure as a dict of plane position to a
+    list of ``{"data": (points, 3) array}`` contours, like dicompyler's
+    ``GetStructureCoordinates``."""
+    planes = {}
+    for roi in getattr(rtstruct, "ROIContourSequence", []):
+        if int(roi.ReferencedROINumber) != int(roi_number):
+            continue
+        for contour in getattr(roi, "ContourSequence", []):
+            data = np.asarray(contour.ContourData, dtype=float).reshape(-1, 3)
+            planes.setdefault(round(float(data[0, 2]), 2), []).append({"data": data})
+    return dict(sorted(planes.items()))
+
+
+def plane_thickness(planes):
+    """Smallest distance between two planes, 0 for a single plane."""
+    if len(planes) < 2:
+        return 0
+    return float(np.min(np.diff(sorted(planes))))
+
+
+def calculate_dvhs(
+    rtstruct,
+    dose_file,
+    structures,
+    limit,
+    progress=None,
+    log=None,
+    description="DVH",
+    mask_cache=None,
+):
+    """Calculate the DVH of every given structure for one dose file.
+
+    The dose file is read once. Each structure is rasterised on the dose
+    grid within its bounding box, or taken from ``mask_cache`` (the cache
+    shared by the process if None), and the histograms of all structures are
+    then filled in a single pass over the dose planes with ``np.bincount``
+    on the dose in cGy. Binning and volumes follow
+    ``dicompylercore.dvhcalc.get_dvh`` without interpolation: voxels above
+    the limit are ignored, planes outside of the dose grid only count for
+    the volume.
+
+    Parameters
+    ----------
+    rtstruct : Dataset or str
+        The RTSTRUCT dataset or file.
+    dose_file : str
+        Path of the RTDOSE file.
+    structures : list
+        (ROI number, name, colour) tuples of the structures to calculate.
+    limit : int
+        Dose limit in cGy, the highest histogram bin.
+    progress : callable, optional
+        Called with the completed fraction of the rasterisation and of the
+        histogram pass.
+    log : callable, optional
+        Called with a status message before each structure.
+    description : str, optional
+        Name of the DVH set used in the status messages.
+    mask_cache : MaskCache, optional
+        Cache of the structure masks.
+
+    Returns
+    -------
+    list
+        The cumulative DVH of every structure.
+    """
+    if not isinstance(rtstruct, Dataset):
+        rtstruct = dcmread(rtstruct)
+    if mask_cache is None:
+        mask_cache = MASK_CACHE
+    dose = read_dose_volume(dose_file)
+    lut = dose.lut
+    voxel_area = abs(np.mean(np.diff(lut[0]))) * abs(np.mean(np.diff(lut[1])))
+
+    maxdose = int(np.max(dose.pixels) * dose.scaling * 100) + 1
+    if isinstance(limit, int) and limit < maxdose:
+        maxdose = limit
+
+    masks = []
+    for k, structure in enumerate(structures):
+        if log is not None:
+            log(f"Calculating {description} for structure {structure[1]} ...")
+        if progress is not None:
+            progress(k / len(structures) / 2)
+        planes = structure_planes(rtstruct, structure[0])
+        if not planes:
+            masks.append((planes, None, None))
+            continue
+        columns, rows = structure_bounding_box(planes, lut, margin=0)
+        x, y = lut[0][columns], lut[1][rows]
+
+        def rasterise():
+            return np.array([contours_mask([c["data"] for c in plane], x, y) for plane in planes.values()])
+
+        uid = getattr(rtstruct, "SOPInstanceUID", None) or getattr(rtstruct, "filename", "")
+        key = mask_cache.key(uid, structure[0], (list(planes), y, x))
+        masks.append((planes, (rows, columns), mask_cache.get(key, rasterise)))
+
+    # One pass over the dose planes for all structures
+    histograms = [np.zeros(maxdose, dtype=np.int64) for _ in structures]
+    voxels = [0] * len(structures)
+    indices = [{z: i for i, z in enumerate(planes)} for planes, _, _ in masks]
+    positions = sorted({z for planes, _, _ in masks for z in planes})
+    for n, z in enumerate(positions):
+        if progress is not None:
+            progress(0.5 + n / len(positions) / 2)
+        doseplane = dose.plane(z)
+        cgy = doseplane * dose.scaling * 100 if doseplane.size else None
+        for k, (planes, box, mask) in enumerate(masks):
+            if z not in planes:
+                continue
+            plane_mask = mask[indices[k][z]]
+            if cgy is None:
+                voxels[k] += np.count_nonzero(plane_mask)
+                continue
+            values = cgy[box][plane_mask]
+            values = values[(values >= 0) & (values <= maxdose)]
+            bins = np.minimum(values.astype(np.int64), maxdose - 1)
+            counts = np.bincount(bins, minlength=maxdose)
+            histograms[k] += counts
+            voxels[k] += counts.sum()
+
+    dvh = []
+    for structure, (planes, _, _), histogram, voxel_count in zip(structures, masks, histograms, voxels):
+        volume = voxel_count * voxel_area * plane_thickness(planes) / 1000
+        notes = None
+        if not histogram.any():
+            counts, notes = np.array([0.0]), "Empty DVH"
+        else:
+            counts = np.trim_zeros(histogram * volume / histogram.sum(), trim="b")
+        bins = np.arange(0, 2) if counts.size == 1 else np.arange(0, counts.size + 1) / 100
+        dvh.append(DVH(structure[1], counts[::-1].cumsum()[::-1], bins, notes=notes))
+    return dvh
+
+
+def calculate_dvh_sets(
+    rtstruct_file,
+    dose_files,
+    structures,
+    limit,
+    workers=1,
+    progress=None,
+    log=None,
+    mask_cache=None,
+):
+    """Calculate the DVHs of the same structures for several dose files.
+
+    With more than one worker the structures are split into contiguous
+    chunks and each chunk is calculated for all dose files by one task of a
+    process pool. A task reads the RTSTRUCT and every dose file once and
+    rasterises each of its structures once for all dose files on the same
+    grid, so no mask is rasterised by two workers.
+
+    Parameters
+    ----------
+    rtstruct_file : str
+        Path of the RTSTRUCT file.
+    dose_files : dict
+        Path of the RTDOSE file of every DVH set, keyed by the description
+        of the set, e.g. ``{"TOPAS DVH": ..., "Reference DVH": ...}``.
+    structures : list
+        (ROI number, name, colour) tuples of the structures to calculate.
+    limit : int
+        Dose limit in cGy.
+    workers : int, optional
+        Number of worker processes. Defaults to 1, which calculates the sets
+        one after the other in the calling process.
+    progress : callable, optional
+        Called with the completed fraction of all sets.
+    log : callable, optional
+        Called with a status message for each structure or finished task.
+    mask_cache : MaskCache, optional
+        Cache of the structure masks. The worker processes share it through
+        its directory, if it has one, which keeps the masks between runs.
+
+    Returns
+    -------
+    dict
+        The list of DVHs of every set, keyed by its description, in the
+        order of ``structures``.
+    """
+    descriptions = list(dose_files)
+    if workers is None or workers <= 1 or not structures:
+        dvhs = {}
+        for k, description in enumerate(descriptions):
+            report = None
+            if progress is not None:
+                def report(fraction, k=k):
+                    progress((k + fraction) / len(descriptions))
+            dvhs[description] = calculate_dvhs(
+                rtstruct_file,
+                dose_files[description],
+                structures,
+                limit,
+                progress=report,
+                log=log,
+                description=description,
+                mask_cache=mask_cache,
+            )
+        return dvhs
+
+    chunks = min(len(structures), workers)
+    bounds = np.linspace(0, len(structures), chunks + 1).astype(int)
+    tasks = [structures[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    directory = getattr(mask_cache, "directory", None)
+    results = {}
+    with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {
+            executor.submit(_dvh_task, rtstruct_file, dose_files, chunk, limit, directory): n
+            for n, chunk in enumerate(tasks)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            n = futures[future]
+            results[n] = future.result()
+            if log is not None:
+                log(f"Calculated {', '.join(descriptions)} for {', '.join(str(structure[1]) for structure in tasks[n])}")
+            if progress is not None:
+                progress(done / len(tasks))
+
+    return {
+        description: [dvh for n in range(len(tasks)) for dvh in results[n][description]]
+        for description in descriptions
+    }
+
+
+def _dvh_task(rtstruct_file, dose_files, structures, limit, mask_cache_directory):
+    """Calculate the DVHs of one chunk of structures for every dose file.
+    Runs in the worker processes; the masks of the first dose file are
+    reused for the others from the same cache."""
+    mask_cache = MASK_CACHE if mask_cache_directory is None else MaskCache(directory=mask_cache_directory)
+    rtstruct = dcmread(rtstruct_file)
+    return {
+        description: calculate_dvhs(rtstruct, dose_file, structures, limit, description=description, mask_cache=mask_cache)
+        for description, dose_file in dose_files.items()
+    }
+
+
+def plot_dvhs(topas_dvh, ref_dvh, structures, xmax, path):
+    """Plot TOPAS and reference DVHs of the same structures into one figure
+    and save it to ``path``."""
+    import matplotlib as mpl
+
+    mpl.use("Agg")
+    import matplotlib.pyplot as plt
+
+    colors = {structure[1]: structure[2] for structure in structures}
+    figure = plt.figure()
+    for topas, ref in zip(topas_dvh, ref_dvh):
+        plt.plot(
+            topas.bincenters,
+            topas.relative_volume.counts,
+            label=topas.name + " - TOPAS",
+            color=colors[topas.name],
+            linestyle="--",
+            linewidth=0.5,
+        )
+
+        plt.plot(
+            ref.bincenters,
+            ref.relative_volume.counts,
+            label=ref.name + " - Ref",
+            color=colors[ref.name],
+            linewidth=0.5,
+        )
+
+    plt.xlabel("Dosis [%s]" % ref_dvh[0].dose_units)
+    plt.ylabel("Volumen [%s]" % ref_dvh[0].relative_volume.volume_units)
+    plt.xlim(left=0, right=xmax)
+    plt.grid()
+    figure.legend(bbox_to_anchor=(0.5,-0.05), loc="upper center", ncols=5, fancybox=True, shadow=True, prop={'size': 8})
+    figure.tight_layout()
+    plt.savefig(path, dpi=600, bbox_inches='tight')
+    plt.close(figure)
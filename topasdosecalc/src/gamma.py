@@ -1,11 +1,11 @@
-from dicompylercore import dicomparser
 import collections
 from six import iteritems
 import numpy as np
-import matplotlib
-import pymedphys
-from skimage.transform import rescale
-from PIL import Image, ImageOps
+from .dose_volume import read_dose_volume
+from .shells import calculate_coordinates_shell
+from .rasterize import contours_mask, interpolate_masks, structure_bounding_box
+from .mask_cache import MASK_CACHE
+from .interpolation import make_interpolator, UniformGridInterpolator
 
 # Copyright (C) 2015-2018 Simon Biggs
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -25,15 +25,14 @@ from PIL import Image, ImageOps
 """
 
 import logging
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from typing import Any, Callable, Optional
 from warnings import warn
 
-from pymedphys._imports import numpy as np
-from pymedphys._imports import scipy
-import pymedphys._utilities.createshells
 
 DEFAULT_RAM = int(2**30 * 1.5)  # 1.5 GB
+GAMMA_BLOCK_POINTS = 2**20
 
 
 def gamma(
@@ -41,7 +40,6 @@ def gamma(
     dose_reference,
     axes_evaluation,
     dose_evaluation,
-    pbvar,
     dose_percent_threshold,
     distance_mm_threshold,
     lower_percent_dose_cutoff=20,
@@ -53,6 +51,12 @@ def gamma(
     random_subset=None,
     ram_available=DEFAULT_RAM,
     quiet=None,
+    progress=None,
+    shell_cache=None,
+    workers=1,
+    pass_fail_only=False,
+    dtype=np.float64,
+    reference_mask=None,
 ):
     """Compare two dose grids with the gamma index.
 
@@ -94,7 +98,9 @@ def gamma(
         values larger than this parameter, the search stops. Defaults to :obj:`np.inf`
     local_gamma
         Designates local gamma should be used instead of global. Defaults to
-        False.
+        False. A list with one entry per dose threshold computes global and
+        local gamma from the same search; the keys of the returned dict then
+        are ``(dose threshold, distance threshold, local)``.
     global_normalisation : float, optional
         The dose normalisation value that the percent inputs calculate from.
         Defaults to the maximum value of :obj:`dose_reference`.
@@ -102,8 +108,10 @@ def gamma(
         Used to only calculate a random subset of the reference grid. The
         number chosen is how many random points to calculate.
     ram_available : int, optional
-        The number of bytes of RAM available for use by this function. Defaults
-        to 0.8 times your total RAM as determined by psutil.
+        Upper bound in bytes for the scratch memory of the distance search.
+        The search interpolates at most ``GAMMA_BLOCK_POINTS`` points at once,
+        which needs about 64 MB, and smaller values of ``ram_available``
+        reduce the block size further.
     quiet : bool, optional
         Deprecated but maintained for now for backwards compatibility.
         `pymedphys.gamma` now utilises the `logging` module. You can set
@@ -111,6 +119,34 @@ def gamma(
         level. Basic information is given for the `info` level.
         Additional information using for benchmarking or troubleshooting
         performance is provided for the `debug` level.
+    progress : callable, optional
+        Called with the fraction of the maximum search distance reached.
+    shell_cache : ShellCache, optional
+        Cache of the distance shells. Defaults to the cache shared by all
+        gamma calculations in the process.
+    workers : int, optional
+        Number of threads searching chunks of reference points in parallel.
+        NumPy releases the GIL in the interpolation and reduction kernels.
+        Every thread needs its own block of scratch memory.
+    pass_fail_only : bool, optional
+        Only decide whether each point passes, see :func:`gamma_pass_fail`.
+        The returned arrays then hold 1 for points with gamma <= 1, 0 for
+        the others and NaN where the full calculation would give NaN, so the
+        pass rate is exactly that of a full run with the same single
+        criterion.
+    dtype : np.dtype, optional
+        Precision of the reference dose and of the gamma arrays. With
+        ``np.float32`` they need half the memory; the evaluation dose is
+        always interpolated in float32. Gamma is calculated in float64 and
+        stored rounded towards +inf, so a gamma above 1 is never stored as
+        1. Values can still differ from float64 mode in the last float32
+        bit, and local gamma by the rounding of the reference dose used for
+        its normalisation. Reference coordinates are computed from the axes
+        when needed, so no meshgrid of the reference grid is kept in either
+        mode.
+    reference_mask : np.ndarray, optional
+        Boolean array of the shape of the reference dose. Only reference
+        points inside the mask are calculated, e.g. the voxels of a structure.
 
     Returns
     -------
@@ -138,10 +174,16 @@ def gamma(
         random_subset,
         ram_available,
         quiet,
+        shell_cache,
+        workers,
+        dtype,
+        reference_mask,
     )
 
-    if options.local_gamma:
+    if np.all(options.local_gamma):
         logging.info("Computing the gamma using local normalisation point")
+    elif np.any(options.local_gamma):
+        logging.info("Computing the gamma using global and local normalisation")
     else:
         logging.info("Computing the gamma using global normalisation point")
 
@@ -159,20 +201,26 @@ def gamma(
         lower_percent_dose_cutoff,
     )
 
-    current_gamma = gamma_loop(options, pbvar)
+    if pass_fail_only:
+        current_gamma = gamma_pass_fail(options, progress)
+    else:
+        current_gamma = gamma_loop(options, progress)
 
     gamma = {}
     for i, dose_threshold in enumerate(options.dose_percent_threshold):
         for j, distance_threshold in enumerate(options.distance_mm_threshold):
             key = (dose_threshold, distance_threshold)
+            if np.ndim(local_gamma) > 0:
+                key += (bool(options.local_gamma[i]),)
 
             gamma_temp = current_gamma[:, i, j]
             gamma_temp = np.reshape(gamma_temp, np.shape(dose_reference))
             gamma_temp[np.isinf(gamma_temp)] = np.nan
 
-            with np.errstate(invalid="ignore"):
-                gamma_greater_than_ref = gamma_temp > max_gamma
-                gamma_temp[gamma_greater_than_ref] = max_gamma
+            if not pass_fail_only:
+                with np.errstate(invalid="ignore"):
+                    gamma_greater_than_ref = gamma_temp > max_gamma
+                    gamma_temp[gamma_greater_than_ref] = max_gamma
 
             gamma[key] = gamma_temp
 
@@ -199,7 +247,7 @@ def expand_dims_to_1d(array):
 
 @dataclass(frozen=True)
 class GammaInternalFixedOptions:
-    flat_mesh_axes_reference: Any
+    axes_reference: Any
     flat_dose_reference: Any
     reference_points_to_calc: Any
     dose_percent_threshold: Any
@@ -210,10 +258,14 @@ class GammaInternalFixedOptions:
     lower_dose_cutoff: float = 0
     maximum_test_distance: float = -1
     global_normalisation: Optional[float] = None
-    local_gamma: bool = False
+    local_gamma: Any = False
     skip_once_passed: bool = False
     ram_available: Optional[int] = DEFAULT_RAM
     quiet: Any = None
+    shell_cache: Any = None
+    workers: int = 1
+    axes_evaluation: Any = None
+    dtype: Any = np.float64
 
     def __post_init__(self):
         self.set_defaults()
@@ -227,6 +279,34 @@ class GammaInternalFixedOptions:
                 self, "global_normalisation", np.max(self.flat_dose_reference)
             )
 
+    @property
+    def num_dimensions(self):
+        return len(self.axes_reference)
+
+    def reference_coordinates(self, points):
+        """Return the (num_dimensions, len(points)) coordinates of the
+        reference points with the given flat indices.
+
+        The coordinates are computed from the axes on demand instead of
+        keeping a meshgrid of the whole reference grid in memory.
+        """
+        shape = tuple(len(axis) for axis in self.axes_reference)
+        indices = np.unravel_index(points, shape)
+        return np.array([axis[index] for axis, index in zip(self.axes_reference, indices)])
+
+    def gamma_array(self):
+        """Return a new (points, dose thresholds, distance thresholds) array
+        of inf."""
+        return np.full(
+            (
+                len(self.flat_dose_reference),
+                len(self.dose_percent_threshold),
+                len(self.distance_mm_threshold),
+            ),
+            np.inf,
+            dtype=self.dtype,
+        )
+
     @property
     def global_dose_threshold(self):
         return self.dose_percent_threshold / 100 * self.global_normalisation
@@ -249,6 +329,10 @@ class GammaInternalFixedOptions:
         random_subset=None,
         ram_available=None,
         quiet=None,
+        shell_cache=None,
+        workers=1,
+        dtype=np.float64,
+        reference_mask=None,
     ):
 
         if max_gamma is None:
@@ -257,6 +341,9 @@ class GammaInternalFixedOptions:
 
         dose_percent_threshold = expand_dims_to_1d(dose_percent_threshold)
         distance_mm_threshold = expand_dims_to_1d(distance_mm_threshold)
+        local_gamma = np.broadcast_to(
+            expand_dims_to_1d(local_gamma), np.shape(dose_percent_threshold)
+        ).astype(bool)
 
         if global_normalisation is None:
             global_normalisation = np.max(dose_reference)
@@ -265,22 +352,18 @@ class GammaInternalFixedOptions:
 
         maximum_test_distance = np.max(distance_mm_threshold) * max_gamma
 
-        evaluation_interpolation = scipy.interpolate.RegularGridInterpolator(
+        evaluation_interpolation = make_interpolator(
             axes_evaluation,
-            np.array(dose_evaluation),
-            bounds_error=False,
+            dose_evaluation,
             fill_value=np.inf,
         )
 
-        dose_reference = np.array(dose_reference)
+        dose_reference = np.asarray(dose_reference, dtype=dtype)
         reference_dose_above_threshold = dose_reference >= lower_dose_cutoff
 
-        mesh_axes_reference = np.meshgrid(*axes_reference, indexing="ij")
-        flat_mesh_axes_reference = np.array(
-            [np.ravel(item) for item in mesh_axes_reference]
-        )
-
         reference_points_to_calc = reference_dose_above_threshold
+        if reference_mask is not None:
+            reference_points_to_calc = reference_points_to_calc & np.asarray(reference_mask, dtype=bool)
         reference_points_to_calc = np.ravel(reference_points_to_calc)
 
         if random_subset is not None:
@@ -299,7 +382,7 @@ class GammaInternalFixedOptions:
         flat_dose_reference = np.ravel(dose_reference)
 
         return cls(
-            flat_mesh_axes_reference,
+            tuple(np.asarray(axis, dtype=float) for axis in axes_reference),
             flat_dose_reference,
             reference_points_to_calc,
             dose_percent_threshold,
@@ -314,22 +397,53 @@ class GammaInternalFixedOptions:
             skip_once_passed,
             ram_available,
             quiet,
+            shell_cache,
+            max(1, int(workers)),
+            tuple(np.asarray(axis, dtype=float) for axis in axes_evaluation),
+            np.dtype(dtype),
         )
 
 
-def gamma_loop(options: GammaInternalFixedOptions, pbvar):
+def gamma_loop(options: GammaInternalFixedOptions, progress=None):
+    """Search the gamma of every criterion on shells of increasing distance.
+
+    The step size of the search depends on the distance threshold, so each
+    distance threshold is searched on its own, with the schedule and
+    maximum test distance of a single criterion run. The dose thresholds
+    and global and local gamma of the same distance share one search. Every
+    result is therefore the same as that of a run with only its criterion.
+    """
+    executor = ThreadPoolExecutor(max_workers=options.workers) if options.workers > 1 else None
+    distances = options.distance_mm_threshold
+    try:
+        if len(distances) == 1:
+            return gamma_search(options, progress, executor)
+
+        current_gamma = options.gamma_array()
+        for j, distance_threshold in enumerate(distances):
+            report = None
+            if progress is not None:
+                def report(fraction, j=j):
+                    progress((j + fraction) / len(distances))
+            single = replace(
+                options,
+                distance_mm_threshold=distances[j:j + 1],
+                maximum_test_distance=min(options.maximum_test_distance, distance_threshold * options.max_gamma),
+            )
+            current_gamma[:, :, j] = gamma_search(single, report, executor)[:, :, 0]
+        return current_gamma
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def gamma_search(options: GammaInternalFixedOptions, progress=None, executor=None):
 
     still_searching_for_gamma = np.full_like(
         options.flat_dose_reference, True, dtype=bool
     )
 
-    current_gamma = np.inf * np.ones(
-        (
-            len(options.flat_dose_reference),
-            len(options.dose_percent_threshold),
-            len(options.distance_mm_threshold),
-        )
-    )
+    current_gamma = options.gamma_array()
 
     distance_step_size = np.min(options.distance_mm_threshold) / options.interp_fraction
 
@@ -338,21 +452,22 @@ def gamma_loop(options: GammaInternalFixedOptions, pbvar):
 
     force_search_distances = np.sort(options.distance_mm_threshold)
     while distance <= options.maximum_test_distance:
-        pbvar.set(distance/options.maximum_test_distance)
+        if progress is not None:
+            progress(distance/options.maximum_test_distance)
         logging.debug(
             "Current distance: %.2f mm | " "Number of reference points remaining: %i",
             distance,
             np.sum(to_be_checked),
         )
 
-        min_relative_dose_difference = calculate_min_dose_difference(
-            options, distance, to_be_checked, distance_step_size
+        min_dose_difference = calculate_min_dose_difference(
+            options, distance, to_be_checked, distance_step_size, executor
         )
 
         current_gamma, still_searching_for_gamma_all = multi_thresholds_gamma_calc(
             options,
             current_gamma,
-            min_relative_dose_difference,
+            min_dose_difference,
             distance,
             to_be_checked,
         )
@@ -388,36 +503,184 @@ def gamma_loop(options: GammaInternalFixedOptions, pbvar):
             if distance >= force_search_distances[0]:
                 distance = force_search_distances[0]
                 force_search_distances = np.delete(force_search_distances, 0)
-    pbvar.set(0)
     return current_gamma
 
 
+def gamma_pass_fail(options: GammaInternalFixedOptions, progress=None):
+    """Decide for every reference point whether its gamma is <= 1.
+
+    Each criterion is handled on its own, with the distance schedule of a
+    single criterion run, so the decision is exactly that of
+    the full calculation:
+
+    1. Points whose gamma at distance 0 is <= 1 pass.
+    2. Points for which even the closest dose found anywhere in the box of
+       half width DTA around them differs by more than the dose criterion
+       fail, see :func:`clear_fails`. This bound is only used for points
+       with a finite gamma at distance 0, which are valid in the full run.
+    3. The remaining points are searched shell by shell up to the DTA,
+       where a gamma <= 1 can still be found, and stop once they pass.
+       Points without any evaluation dose at distance 0 are searched up to
+       the full search distance, as they are NaN in the full run if no
+       evaluation dose is found anywhere.
+
+    Returns
+    -------
+    np.ndarray
+        1 for passing points, 0 for failing ones and inf for points that are
+        not calculated or have no evaluation dose within the search distance.
+    """
+    result = options.gamma_array()
+    num_steps = result.shape[1] * result.shape[2]
+    for i, dose_threshold in enumerate(options.dose_percent_threshold):
+        for j, distance_threshold in enumerate(options.distance_mm_threshold):
+            if progress is not None:
+                progress((i * result.shape[2] + j) / num_steps)
+            single = replace(
+                options,
+                dose_percent_threshold=options.dose_percent_threshold[i:i + 1],
+                local_gamma=options.local_gamma[i:i + 1],
+                distance_mm_threshold=options.distance_mm_threshold[j:j + 1],
+                maximum_test_distance=distance_threshold * options.max_gamma,
+            )
+            result[:, i, j] = pass_fail_single_criterion(single)
+    return result
+
+
+def pass_fail_single_criterion(options: GammaInternalFixedOptions):
+    distance_threshold = options.distance_mm_threshold[0]
+    to_calc = options.reference_points_to_calc
+    passed = np.full(len(options.flat_dose_reference), np.inf, dtype=options.dtype)
+
+    if options.max_gamma <= 1:
+        # Every finite gamma is clipped to max_gamma and passes
+        current_gamma = gamma_loop(options)[:, 0, 0]
+        passed[np.isfinite(current_gamma)] = 1
+        return passed
+
+    current_gamma = options.gamma_array()
+    min_dose_difference = calculate_min_dose_difference(
+        options, 0.0, to_calc, distance_threshold / options.interp_fraction
+    )
+    current_gamma, _ = multi_thresholds_gamma_calc(
+        options, current_gamma, min_dose_difference, 0.0, to_calc
+    )
+    gamma_at_zero = current_gamma[:, 0, 0]
+
+    passed_at_zero = to_calc & (gamma_at_zero <= 1)
+    passed[passed_at_zero] = 1
+    remaining = to_calc & ~passed_at_zero
+    valid = remaining & np.isfinite(gamma_at_zero)
+
+    failed = np.zeros_like(valid)
+    failed[valid] = clear_fails(options, np.where(valid)[0])
+    passed[failed] = 0
+    logging.debug(
+        "Passed at distance 0: %i | Clear fails: %i | Searched: %i",
+        np.count_nonzero(passed_at_zero),
+        np.count_nonzero(failed),
+        np.count_nonzero(remaining & ~failed),
+    )
+
+    for undecided, maximum_test_distance in (
+        (valid & ~failed, distance_threshold),
+        (remaining & ~valid, options.maximum_test_distance),
+    ):
+        if not np.any(undecided):
+            continue
+        current_gamma = gamma_loop(
+            replace(
+                options,
+                reference_points_to_calc=undecided,
+                skip_once_passed=True,
+                maximum_test_distance=maximum_test_distance,
+            )
+        )[:, 0, 0]
+        found = undecided & np.isfinite(current_gamma)
+        passed[found] = np.where(current_gamma[found] <= 1, 1, 0)
+    return passed
+
+
+def clear_fails(options: GammaInternalFixedOptions, points):
+    """Return which of the reference ``points`` fail for every distance up to
+    the DTA on dose alone.
+
+    The interpolated evaluation dose in the box of half width DTA around a
+    point lies between the minimum and maximum of the grid values of the
+    cells covering the box, which a min/max filter over the evaluation grid
+    gives for all points at once. If the reference dose differs from that
+    range by more than the dose criterion, the gamma exceeds 1 at every
+    distance. Only available for uniform evaluation grids; otherwise no
+    point is marked.
+    """
+    from scipy.ndimage import minimum_filter, maximum_filter
+
+    interpolation = options.evaluation_interpolation
+    if not isinstance(interpolation, UniformGridInterpolator):
+        return np.zeros(len(points), dtype=bool)
+
+    distance_threshold = options.distance_mm_threshold[0]
+    values = interpolation.values.reshape(tuple(interpolation.size))
+    size = [2 * (int(np.ceil(distance_threshold / step)) + 1) + 1 for step in interpolation.step]
+    lowest = minimum_filter(values, size=size, mode="nearest")
+    highest = maximum_filter(values, size=size, mode="nearest")
+
+    coordinates = options.reference_coordinates(points)
+    index = 0
+    for i in range(interpolation.ndim):
+        cell = np.floor((coordinates[i] - interpolation.origin[i]) / interpolation.step[i])
+        index = index + np.clip(cell, 0, interpolation.size[i] - 1).astype(np.int64) * interpolation.strides[i]
+    reference_dose = options.flat_dose_reference[points]
+    difference = np.maximum(lowest.ravel()[index] - reference_dose, reference_dose - highest.ravel()[index])
+
+    # Allow for the rounding of the float32 interpolation
+    difference -= 1e-5 * np.max(np.abs(values))
+    if options.local_gamma[0]:
+        tolerance = options.dose_percent_threshold[0] / 100 * reference_dose
+    else:
+        tolerance = options.dose_percent_threshold[0] / 100 * options.global_normalisation
+    return difference > tolerance
+
+
 def multi_thresholds_gamma_calc(
     options: GammaInternalFixedOptions,
     current_gamma,
-    min_relative_dose_difference,
+    min_dose_difference,
     distance,
     to_be_checked,
 ):
 
+    # Global and local gamma share the minimum absolute dose difference and
+    # only differ in its normalisation.
+    normalisation = np.where(
+        options.local_gamma[None, :],
+        options.flat_dose_reference[to_be_checked][:, None],
+        options.global_normalisation,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        min_relative_dose_difference = min_dose_difference[:, None] / normalisation
+
     gamma_at_distance = np.sqrt(
         (
-            min_relative_dose_difference[:, None, None]
+            min_relative_dose_difference[:, :, None]
             / (options.dose_percent_threshold[None, :, None] / 100)
         )
         ** 2
         + (distance / options.distance_mm_threshold[None, None, :]) ** 2
     )
 
-    current_gamma[to_be_checked, :, :] = np.min(
-        np.concatenate(
-            [
-                gamma_at_distance[None, :, :, :],
-                current_gamma[None, to_be_checked, :, :],
-            ],
+    current_gamma[to_be_checked, :, :] = round_up(
+        np.min(
+            np.concatenate(
+                [
+                    gamma_at_distance[None, :, :, :],
+                    current_gamma[None, to_be_checked, :, :],
+                ],
+                axis=0,
+            ),
             axis=0,
         ),
-        axis=0,
+        current_gamma.dtype,
     )
 
     still_searching_for_gamma = current_gamma > (
@@ -430,121 +693,166 @@ def multi_thresholds_gamma_calc(
     return current_gamma, still_searching_for_gamma
 
 
-def calculate_min_dose_difference(options, distance, to_be_checked, distance_step_size):
-    """Determine the minimum dose difference.
+def round_up(values, dtype):
+    """Convert float64 gamma values to ``dtype``, rounding towards +inf.
 
-    Calculated for a given distance from each reference point.
+    A gamma above 1 then never becomes 1 in float32, so the gamma <= 1
+    decision is that of the float64 values.
     """
+    converted = values.astype(dtype, copy=False)
+    if converted.dtype != values.dtype:
+        below = converted < values
+        converted[below] = np.nextafter(converted[below], dtype.type(np.inf))
+    return converted
 
-    min_relative_dose_difference = np.nan * np.ones_like(
-        options.flat_dose_reference[to_be_checked]
-    )
-
-    num_dimensions = np.shape(options.flat_mesh_axes_reference)[0]
 
-    coordinates_at_distance_shell = pymedphys._utilities.createshells.calculate_coordinates_shell(  # pylint: disable = protected-access
-        distance, num_dimensions, distance_step_size
-    )
+def calculate_min_dose_difference(options, distance, to_be_checked, distance_step_size, executor=None):
+    """Determine the minimum dose difference.
 
-    num_points_in_shell = np.shape(coordinates_at_distance_shell)[1]
+    Calculated for a given distance from each reference point. The shell
+    points are streamed in blocks of at most ``block_points(options)``
+    evaluation points, and a running minimum of the absolute dose difference
+    is kept per reference point, so the full points x references matrix is
+    never built. With an ``executor``, chunks of reference points are
+    processed in parallel; each worker thread uses its own block buffers.
 
-    estimated_ram_needed = (
-        np.uint64(num_points_in_shell)
-        * np.uint64(np.count_nonzero(to_be_checked))
-        * np.uint64(32)
-        * np.uint64(num_dimensions)
-        * np.uint64(2)
-    )
+    Returns the minimum absolute dose difference. It is normalised in
+    :func:`multi_thresholds_gamma_calc`, so global and local gamma can share
+    it.
+    """
 
-    num_slices = np.floor(estimated_ram_needed / options.ram_available).astype(int) + 1
+    num_dimensions = options.num_dimensions
 
-    logging.debug(
-        "Points tested per reference point: %i | RAM split count: %i",
-        num_points_in_shell,
-        num_slices,
+    coordinates_at_distance_shell = calculate_coordinates_shell(
+        distance, num_dimensions, distance_step_size, options.shell_cache
     )
 
+    num_points_in_shell = np.shape(coordinates_at_distance_shell)[1]
     all_checks = np.where(np.ravel(to_be_checked))[0]
-    index = np.arange(len(all_checks))
-    sliced = np.array_split(index, num_slices)
-
-    sorted_sliced = [np.sort(current_slice) for current_slice in sliced]
+    num_references = len(all_checks)
 
-    for current_slice in sorted_sliced:
-        to_be_checked_sliced = np.full_like(to_be_checked, False, dtype=bool)
-        to_be_checked_sliced[  # pylint: disable=unsupported-assignment-operation
-            all_checks[current_slice]
-        ] = True
+    max_block = block_points(options)
+    references_per_block = max(1, min(num_references, max_block))
+    if executor is not None:
+        # Give every worker at least one chunk of reference points
+        references_per_block = max(1, min(references_per_block, -(-num_references // options.workers)))
+    shell_points_per_block = max(1, min(num_points_in_shell, max_block // references_per_block))
 
-        assert np.all(to_be_checked[to_be_checked_sliced])
+    logging.debug(
+        "Points tested per reference point: %i | Block: %i x %i",
+        num_points_in_shell,
+        shell_points_per_block,
+        references_per_block,
+    )
 
-        axes_reference_to_be_checked = options.flat_mesh_axes_reference[
-            :, to_be_checked_sliced
-        ]
+    min_dose_difference = np.full(num_references, np.inf)
+    chunks = [
+        (all_checks[r:r + references_per_block], min_dose_difference[r:r + references_per_block])
+        for r in range(0, num_references, references_per_block)
+    ]
 
-        evaluation_dose = interpolate_evaluation_dose_at_distance(
-            options.evaluation_interpolation,
-            axes_reference_to_be_checked,
-            coordinates_at_distance_shell,
+    def run(chunk):
+        min_dose_difference_chunk(
+            options, coordinates_at_distance_shell, *chunk, shell_points_per_block
         )
 
-        if options.local_gamma:
-            with np.errstate(divide="ignore"):
-                relative_dose_difference = (
-                    evaluation_dose
-                    - options.flat_dose_reference[to_be_checked_sliced][None, :]
-                ) / (options.flat_dose_reference[to_be_checked_sliced][None, :])
-        else:
-            relative_dose_difference = (
-                evaluation_dose
-                - options.flat_dose_reference[to_be_checked_sliced][None, :]
-            ) / options.global_normalisation
-
-        min_relative_dose_difference[current_slice] = np.min(
-            np.abs(relative_dose_difference), axis=0
-        )
+    if executor is None:
+        for chunk in chunks:
+            run(chunk)
+    else:
+        for future in [executor.submit(run, chunk) for chunk in chunks]:
+            future.result()
 
-    return min_relative_dose_difference
+    return min_dose_difference
 
 
-def interpolate_evaluation_dose_at_distance(
-    evaluation_interpolation,
-    axes_reference_to_be_checked,
+def min_dose_difference_chunk(
+    options,
     coordinates_at_distance_shell,
+    checks,
+    running_min,
+    shell_points_per_block,
 ):
-    """Determine the evaluation dose for the points a given distance away for
-    each reference coordinate.
-    """
-    all_points = add_shells_to_ref_coords(
-        axes_reference_to_be_checked, coordinates_at_distance_shell
-    )
+    """Fold the absolute dose difference at every shell point into
+    ``running_min`` for one chunk of reference points."""
+    dtype = getattr(options.evaluation_interpolation, "dtype", np.float64)
+    block = np.empty(shell_points_per_block * len(checks), dtype=dtype)
+    block_min = np.empty(len(checks), dtype=dtype)
+    reference_coordinates = options.reference_coordinates(checks)
+    reference_dose = options.flat_dose_reference[checks].astype(dtype)
+
+    for k in range(0, np.shape(coordinates_at_distance_shell)[1], shell_points_per_block):
+        shell = coordinates_at_distance_shell[:, k:k + shell_points_per_block]
+        evaluation_dose = block[:shell.shape[1] * len(checks)].reshape((shell.shape[1], len(checks)))
+        interpolate_shell_block(
+            options.evaluation_interpolation,
+            reference_coordinates,
+            shell,
+            evaluation_dose,
+        )
+        np.subtract(evaluation_dose, reference_dose[None, :], out=evaluation_dose)
+        np.abs(evaluation_dose, out=evaluation_dose)
+        np.min(evaluation_dose, axis=0, out=block_min)
+        np.minimum(running_min, block_min, out=running_min)
 
-    evaluation_dose = evaluation_interpolation(all_points)
 
-    return evaluation_dose
+def block_points(options):
+    """Number of evaluation points interpolated at once. Every point needs
+    about 64 bytes of scratch memory."""
+    if options.ram_available is None:
+        return GAMMA_BLOCK_POINTS
+    return int(max(1, min(GAMMA_BLOCK_POINTS, options.ram_available // 64)))
 
 
-def add_shells_to_ref_coords(
-    axes_reference_to_be_checked, coordinates_at_distance_shell
+def interpolate_shell_block(
+    evaluation_interpolation,
+    reference_coordinates,
+    shell,
+    out,
 ):
-    """Add the distance shells to each reference coordinate to make a set of
-    points to be tested for this given distance"""
-
-    coordinates_at_distance = []
-    for shell_coord, ref_coord in zip(
-        coordinates_at_distance_shell, axes_reference_to_be_checked
-    ):
-
-        coordinates_at_distance.append(
-            np.array(ref_coord[None, :] + shell_coord[:, None])[:, :, None]
+    """Interpolate the evaluation dose at every shell point around every
+    reference point into ``out`` of shape (shell points, reference points)."""
+    if isinstance(evaluation_interpolation, UniformGridInterpolator):
+        return evaluation_interpolation.evaluate(
+            [ref_coord[None, :] for ref_coord in reference_coordinates],
+            out,
+            offsets=[shell_coord[:, None] for shell_coord in shell],
         )
 
-    all_points = np.concatenate(coordinates_at_distance, axis=2)
+    all_points = np.stack(
+        [ref_coord[None, :] + shell_coord[:, None] for shell_coord, ref_coord in zip(shell, reference_coordinates)],
+        axis=-1,
+    )
+    out[...] = evaluation_interpolation(all_points)
+    return out
+
+
+def crop_dose_to_roi(
+    rtdose_file,
+    rtstruct_file,
+    roi_number,
+    progress=None,
+    dtype=np.float64,
+    margin=None,
+    return_mask=False,
+    mask_cache=None,
+):
+    """Interpolate an RTDOSE file onto the grid of a structure and set the
+    dose outside of it to 0.
 
-    return all_points
+    The volume spans the planes of the structure. In-plane it covers the
+    bounding box of the contours plus ``margin`` mm, or the whole dose plane
+    if ``margin`` is None.
 
+    The structure mask is taken from ``mask_cache``, or from the cache
+    shared by the process if None, so the structure is rasterised once per
+    grid.
 
-def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
+    Returns the (z, y, x) axes and the cropped dose volume in ``dtype``, and
+    with ``return_mask`` also the read-only boolean mask of the voxels inside
+    the structure.
+    """
+    from dicompylercore import dicomparser
 
     def dosegrid_extents_indices(extents, dd, padding=1):
         """Determine dose grid extents from structure extents as array indices.
@@ -555,7 +863,7 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
             Structure extents in patient coordintes: [xmin, ymin, xmax, ymax].
             If an empty list, no structure extents will be used in the calculation.
         dd : dict
-            Dose data from dicomparser.GetDoseData.
+            Dose grid data with the 'lut', 'rows' and 'columns' keys.
         padding : int, optional
             Pixel padding around the structure extents.
 
@@ -590,7 +898,7 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
         extents : list
             Dose grid extents in pixel coordintes: [xmin, ymin, xmax, ymax].
         dd : dict
-            Dose data from dicomparser.GetDoseData.
+            Dose grid data with the 'lut', 'rows' and 'columns' keys.
 
         Returns
         -------
@@ -659,33 +967,12 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
         y = np.linspace(extents[1], extents[3], int(ysamples), dtype=float)
         return x, y
 
-    def interpolate_between_planes(planes, n=2):
-        """Interpolate n additional structure planes (segments) in between planes.
-
-        Parameters
-        ----------
-        planes : dict
-            RT Structure plane data from dicomparser.GetStructureCoordinates.
-        n : int, optional
-            Number of planes to interpolate in between the existing planes.
-
-        Returns
-        -------
-        dict
-            Plane data with additional keys representing interpolated planes.
-        """
-        keymap = {np.array([k], dtype=np.float32)[0]: k for k in planes.keys()}
+    def interpolated_plane_positions(planes, n=2):
+        """Return the positions of the structure planes with n additional
+        planes (segments) in between each pair of planes."""
         sorted_keys = np.sort(np.array(list(planes.keys()), dtype=np.float32))
         num_new_samples = (len(planes.keys()) * (n + 1)) - n
-        newgrid = np.linspace(sorted_keys[0], sorted_keys[-1], num_new_samples)
-        new_planes = {}
-        # If the plane already exists in the dictionary, use it
-        # otherwise use the closest plane
-        # TODO: Add actual interpolation of structure data between planes
-        for plane in newgrid:
-            new_plane = sorted_keys[np.argmin(np.fabs(sorted_keys - plane))]
-            new_planes[plane] = planes[keymap[new_plane]]
-        return new_planes
+        return np.linspace(sorted_keys[0], sorted_keys[-1], num_new_samples)
 
 
     def get_interpolated_dose(dose, z, resolution, extents):
@@ -693,8 +980,8 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
 
         Parameters
         ----------
-        dose : DicomParser
-            A DicomParser instance of an RT Dose.
+        dose : DoseVolume
+            The memory-mapped RT Dose.
         z : float
             Index in mm of z plane of dose grid.dose
         resolution : tuple
@@ -709,14 +996,16 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
             Interpolated dose grid with a shape larger than the input dose grid.
         """
         # Return the dose bounded by extents if interpolation is not required
-        d = dose.GetDoseGrid(z)
+        d = dose.plane(z)
         if not d.size:
             return d  # cannot take 2d index below if empty
         extent_dose = d[extents[1]:extents[3],
                         extents[0]:extents[2]] if len(extents) else d
         if not resolution:
             return extent_dose
-        scale = (np.array(dose.ds.PixelSpacing) / resolution).tolist()
+        from skimage.transform import rescale
+
+        scale = (np.array(dose.spacing) / resolution).tolist()
         interp_dose = rescale(
             extent_dose,
             scale=scale,
@@ -727,29 +1016,8 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
         )
         return interp_dose
 
-    def get_contour_mask(dd, dosegridpoints, contour):
-        """Get the mask for the contour with respect to the dose plane."""
-        doselut = dd['lut']
-
-        c = matplotlib.path.Path(list(contour))
-
-        # def inpolygon(polygon, xp, yp):
-        #     return np.array(
-        #         [Point(x, y).intersects(polygon) for x, y in zip(xp, yp)],
-        #         dtype=np.bool)
-
-        # p = Polygon(contour)
-        # x, y = np.meshgrid(np.array(dd['lut'][0]), np.array(dd['lut'][1]))
-        # mask = inpolygon(p, x.ravel(), y.ravel())
-        # return mask.reshape((len(doselut[1]), len(doselut[0])))
-
-        grid = c.contains_points(dosegridpoints)
-        grid = grid.reshape((len(doselut[1]), len(doselut[0])))
-        return grid 
-
-
     rtss = dicomparser.DicomParser(rtstruct_file)
-    rtdose = dicomparser.DicomParser(rtdose_file)
+    rtdose = read_dose_volume(rtdose_file)
     structures = rtss.GetStructures()
     roi = roi_number
     s = structures[roi]
@@ -758,71 +1026,238 @@ def crop_dose_to_roi(rtdose_file, rtstruct_file, roi_number, pbvar):
     planes = collections.OrderedDict(sorted(iteritems(s['planes'])))
 
     def find_interpolation(slice_thickness, dose_grid):
-        
+        """Return the in-plane resolution, a power of two fraction of the
+        dose grid spacing, and the number of planes to interpolate between
+        the structure planes so that their spacing matches it. If no
+        combination matches, the grid spacing is halved and the plane
+        spacing brought as close to it as possible."""
         grid_sizes = [dose_grid/2**i for i in range(1, 10)]
-        slice_thicknesses = [slice_thickness/(i+1) for i in range(10)]
-        
+        if not slice_thickness or not np.isfinite(slice_thickness) or slice_thickness <= 0:
+            return grid_sizes[0], 0
         for i in grid_sizes:
-            for j in slice_thicknesses:
-                if i == j:
-                    return i, slice_thicknesses.index(j)
+            for segments in range(10):
+                if np.isclose(i, slice_thickness/(segments+1), rtol=1e-6, atol=0):
+                    return i, segments
+        return grid_sizes[0], max(0, int(round(slice_thickness/grid_sizes[0])) - 1)
 
-    interpolation_resolution, interpolation_segments_between_planes = find_interpolation(s['thickness'], rtdose.ds.PixelSpacing[0] )
+    interpolation_resolution, interpolation_segments_between_planes = find_interpolation(s['thickness'], rtdose.spacing[0])
 
-    if ((len(planes)) and ("PixelData" in rtdose.ds)):
+    if len(planes):
 
-        dd = rtdose.GetDoseData()
-        id = rtdose.GetImageData()
-        if interpolation_resolution < id['pixelspacing'][0]:
-            extents = []
-            dgindexextents = dosegrid_extents_indices(extents, dd)
+        dd = {'lut': rtdose.lut, 'rows': rtdose.shape[1], 'columns': rtdose.shape[2]}
+        dgindexextents = dosegrid_extents_indices([], dd)
+        if interpolation_resolution < rtdose.spacing[0]:
             dgextents = dosegrid_extents_positions(dgindexextents, dd)
             dd['lut'] = get_resampled_lut(
                 dgindexextents,
                 dgextents,
                 new_pixel_spacing=interpolation_resolution,
-                min_pixel_spacing=id['pixelspacing'][0])
+                min_pixel_spacing=rtdose.spacing[0])
             dd['rows'] = dd['lut'][1].shape[0]
             dd['columns'] = dd['lut'][0].shape[0]
 
-        x, y = np.meshgrid(np.array(dd['lut'][0]), np.array(dd['lut'][1]))
-        x, y = x.flatten(), y.flatten()
-        dosegridpoints = np.vstack((x, y)).T
+        # Only the bounding box of the structure plus the margin is kept
+        columns, rows = structure_bounding_box(planes, dd['lut'], margin)
+        box = {'lut': (dd['lut'][0][columns], dd['lut'][1][rows])}
 
-    planes = interpolate_between_planes(
-                planes, interpolation_segments_between_planes)
+    z = [float(plane) for plane in interpolated_plane_positions(
+                planes, interpolation_segments_between_planes)]
             # Thickness derived from total number of segments relative to original
     s['thickness'] = s['thickness'] / (interpolation_segments_between_planes + 1)
-    map = []   
-    l = 0
-    for z, plane in iteritems(planes):
-        pbvar.set(l/len(planes))
-        contours = [[x[0:2] for x in c['data']] for c in plane]
-        grid = np.zeros((dd['rows'], dd['columns']), dtype=np.uint8)
-        for i, contour in enumerate(contours):
-            m = get_contour_mask(dd, dosegridpoints, contour)
-            grid = np.logical_xor(m.astype(np.uint8), grid).astype(bool)
-        map += [[float(z),np.invert(grid)]]
-        l += 1
-    sorted_map = sorted(map, key=lambda x: x[0])
-    z = [x[0] for x in sorted_map]
-
-    y_flip = y[0] > y[-1]
-    x_flip = x[0] > x[-1]
-    y, x = np.unique(y), np.unique(x)
-    if y_flip:
-        y = np.flip(y)
-    if x_flip:
-        x = np.flip(x)
-        
-    ax = [np.array(z),y,x]
-    dose_grid_scaling = rtdose.ds.DoseGridScaling
-    cropped_dose = []
-    for i in z:
-
-        dose = Image.fromarray((a:=get_interpolated_dose(rtdose,i,interpolation_resolution,dgindexextents)))
-        border = abs(a.shape[0] - grid.shape[0])//2
-        img = ImageOps.expand(dose, border=border)
-        dose = np.array(img)
-        cropped_dose += [np.ma.masked_array(dose, mask=sorted_map[z.index(i)][1]).filled(0) * dose_grid_scaling]
-    return ax, cropped_dose
\ No newline at end of file
+
+    def rasterise():
+        # Only the contour planes are rasterised, the planes in between are
+        # interpolated from their signed distance maps
+        contour_planes = sorted(iteritems(planes), key=lambda plane: float(plane[0]))
+        structure_mask = np.empty((len(planes), len(box['lut'][1]), len(box['lut'][0])), dtype=bool)
+        for l, (_, plane) in enumerate(contour_planes):
+            if progress is not None:
+                progress(l/len(planes))
+            structure_mask[l] = contours_mask([c['data'] for c in plane], box['lut'][0], box['lut'][1])
+        sampling = (abs(box['lut'][1][1] - box['lut'][1][0]) if len(box['lut'][1]) > 1 else 1,
+                    abs(box['lut'][0][1] - box['lut'][0][0]) if len(box['lut'][0]) > 1 else 1)
+        return interpolate_masks([float(k) for k, _ in contour_planes], structure_mask, z, sampling)
+
+    if mask_cache is None:
+        mask_cache = MASK_CACHE
+    ax = [np.array(z), np.array(box['lut'][1]), np.array(box['lut'][0])]
+    roi_mask = mask_cache.get(
+        mask_cache.key(getattr(rtss.ds, 'SOPInstanceUID', rtstruct_file), roi, ax, ("shape-based",)), rasterise
+    )
+
+    dose_grid_scaling = rtdose.scaling
+    cropped_dose = np.empty(roi_mask.shape, dtype=dtype)
+    for k, i in enumerate(z):
+
+        a = get_interpolated_dose(rtdose,i,interpolation_resolution,dgindexextents)
+        border = abs(a.shape[0] - dd['rows'])//2
+        dose = np.pad(a, border)[rows, columns]
+        cropped_dose[k] = np.where(roi_mask[k], dose * dose_grid_scaling, 0)
+    if return_mask:
+        return ax, cropped_dose, roi_mask
+    return ax, cropped_dose
+
+
+def parse_criteria(text):
+    """Parse gamma criteria such as ``"3/3, 3/2, 2/2, 1/1"`` into a list of
+    (dose percent, distance mm) tuples."""
+    criteria = []
+    for item in text.replace(";", ",").split(","):
+        if not item.strip():
+            continue
+        dose, distance = item.split("/")
+        criteria.append((float(dose), float(distance)))
+    if not criteria:
+        raise ValueError("No gamma criteria given")
+    return criteria
+
+
+def gamma_pass_rates(
+    reference_file,
+    evaluation_file,
+    rtstruct_file,
+    roi_number,
+    criteria,
+    gamma_types=("Global",),
+    lower_percent_dose_cutoff=10,
+    interp_fraction=10,
+    max_gamma=2,
+    ram_available=2**32,
+    progress=None,
+    shell_cache=None,
+    workers=1,
+    pass_fail_only=None,
+    dtype=np.float64,
+    mask_cache=None,
+):
+    """Crop two RTDOSE files to a structure and return the gamma pass rates
+    of several criteria.
+
+    Only voxels inside the structure are evaluated. Both doses are cropped
+    to the bounding box of the structure plus the maximum search distance,
+    so the cost scales with the structure instead of the dose grid.
+
+    Parameters
+    ----------
+    criteria : list
+        (dose percent, distance mm) tuples.
+    gamma_types : list, optional
+        ``"Global"`` and/or ``"Local"``.
+    pass_fail_only : bool, optional
+        Only compute the pass/fail decision, see :func:`gamma_pass_fail`.
+        The default None uses it for a single criterion and type, where it
+        gives the same pass rate as the full gamma. With several criteria
+        or types, the full gamma is computed and the criteria with the
+        same distance and global and local gamma share one search: the dose
+        differences found on each shell are shared by all of them. Each distance is searched with its own step size, so every
+        pass rate equals that of a run with only its criterion.
+    dtype : np.dtype, optional
+        Precision of the cropped doses and gamma arrays, ``np.float32``
+        halves their memory.
+    mask_cache : MaskCache, optional
+        Cache of the structure masks, see :func:`crop_dose_to_roi`.
+
+    Returns
+    -------
+    dict
+        The pass rate for every (dose percent, distance mm, gamma type).
+    """
+    criteria = [(float(dose), float(distance)) for dose, distance in criteria]
+    gamma_types = [gamma_type.capitalize() for gamma_type in gamma_types]
+    doses = sorted({dose for dose, _ in criteria}, reverse=True)
+    distances = sorted({distance for _, distance in criteria}, reverse=True)
+    if pass_fail_only is None:
+        pass_fail_only = len(criteria) == 1 and len(gamma_types) == 1
+
+    # Reference points are only searched up to the maximum test distance
+    # outside the structure
+    margin = max(distances) * max_gamma if max_gamma is not None else None
+    axes_reference, dose_reference, roi_mask = crop_dose_to_roi(
+        reference_file, rtstruct_file, roi_number, progress, dtype, margin, return_mask=True, mask_cache=mask_cache
+    )
+    axes_evaluation, dose_evaluation = crop_dose_to_roi(
+        evaluation_file, rtstruct_file, roi_number, progress, dtype, margin, mask_cache=mask_cache
+    )
+
+    gam = gamma(
+        axes_reference,
+        dose_reference,
+        axes_evaluation,
+        dose_evaluation,
+        [dose for _ in gamma_types for dose in doses],
+        distances,
+        lower_percent_dose_cutoff=lower_percent_dose_cutoff,
+        interp_fraction=interp_fraction,
+        max_gamma=max_gamma,
+        local_gamma=[gamma_type == "Local" for gamma_type in gamma_types for _ in doses],
+        ram_available=ram_available,
+        quiet=True,
+        progress=progress,
+        shell_cache=shell_cache,
+        workers=workers,
+        pass_fail_only=pass_fail_only,
+        dtype=dtype,
+        reference_mask=roi_mask,
+    )
+    if not isinstance(gam, dict):
+        gam = {(doses[0], distances[0], gamma_types[0] == "Local"): gam}
+
+    pass_rates = {}
+    for gamma_type in gamma_types:
+        for dose, distance in criteria:
+            values = gam[(dose, distance, gamma_type == "Local")]
+            valid_gamma = values[~np.isnan(values)]
+            # The pass/fail mode marks failing points with 0 instead of gamma
+            passed = valid_gamma == 1 if pass_fail_only else valid_gamma <= 1
+            pass_rates[(dose, distance, gamma_type)] = np.sum(passed) / len(valid_gamma)
+    return pass_rates
+
+
+def gamma_pass_rate(
+    reference_file,
+    evaluation_file,
+    rtstruct_file,
+    roi_number,
+    dose_percent_threshold,
+    distance_mm_threshold,
+    lower_percent_dose_cutoff=10,
+    local_gamma=False,
+    interp_fraction=10,
+    max_gamma=2,
+    ram_available=2**32,
+    progress=None,
+    shell_cache=None,
+    workers=1,
+    pass_fail_only=None,
+    dtype=np.float64,
+    mask_cache=None,
+):
+    """Crop two RTDOSE files to a structure and return the gamma pass rate.
+
+    The pass rate is the fraction of evaluated reference points with
+    gamma <= 1. The other parameters are those of
+    :func:`gamma_pass_rates`; with the default ``pass_fail_only=None`` only
+    the pass/fail decision is computed, which gives exactly the same pass
+    rate faster.
+    ``progress`` is called with the completed fraction of each stage
+    (cropping both doses, then the gamma search).
+    """
+    gamma_type = "Local" if local_gamma else "Global"
+    return gamma_pass_rates(
+        reference_file,
+        evaluation_file,
+        rtstruct_file,
+        roi_number,
+        [(dose_percent_threshold, distance_mm_threshold)],
+        [gamma_type],
+        lower_percent_dose_cutoff=lower_percent_dose_cutoff,
+        interp_fraction=interp_fraction,
+        max_gamma=max_gamma,
+        ram_available=ram_available,
+        progress=progress,
+        shell_cache=shell_cache,
+        workers=workers,
+        pass_fail_only=pass_fail_only,
+        dtype=dtype,
+        mask_cache=mask_cache,
+    )[(float(dose_percent_threshold), float(distance_mm_threshold), gamma_type)]
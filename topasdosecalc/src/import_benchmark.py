@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+# Modules whose import cost matters, with the import time budget in ms and
+# the heavy packages they must not load. Worker processes of the merge only
+# import ``topasdosecalc.src.merge``; ``topasdosecalc.topasdosecalc`` is the
+# console entry point and ``src.options`` is what the GUI loads before its
+# window appears.
+HEAVY_PACKAGES = ("matplotlib", "dicompylercore", "skimage", "pymedphys", "scipy", "mlca")
+GUI_PACKAGES = ("customtkinter", "tkinter")
+IMPORT_BUDGETS = {
+    "topasdosecalc.core": (750, HEAVY_PACKAGES + GUI_PACKAGES),
+    "topasdosecalc.src.merge": (750, HEAVY_PACKAGES + GUI_PACKAGES),
+    "topasdosecalc.src.batch": (750, HEAVY_PACKAGES + GUI_PACKAGES),
+    "topasdosecalc.src.gamma": (750, HEAVY_PACKAGES + GUI_PACKAGES),
+    "topasdosecalc.topasdosecalc": (250, HEAVY_PACKAGES + GUI_PACKAGES),
+    "topasdosecalc batch": (750, HEAVY_PACKAGES + GUI_PACKAGES),
+    "src.options": (2000, HEAVY_PACKAGES),
+}
+# Entries that are not a plain import: what ``topasdosecalc batch`` imports
+# before it runs the first job.
+IMPORT_STATEMENTS = {
+    "topasdosecalc batch": "import topasdosecalc.topasdosecalc as entry; entry.load('batch')",
+}
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|")
+
+
+def measure_import(module, repeat=3):
+    """Import ``module`` in fresh interpreters and return the fastest total
+    import time in ms and the top-level packages it loaded. Entries of
+    ``IMPORT_STATEMENTS`` run their statement instead."""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root, os.path.join(root, "topasdosecalc")] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    statement = IMPORT_STATEMENTS.get(module, f"import {module}")
+    code = f"import sys, json; {statement}; print(json.dumps(sorted({{m.split('.')[0] for m in sys.modules}})))"
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            env=env,
+            cwd=root,
+        )
+        if result.returncode != 0:
+            raise ImportError(result.stderr.strip().splitlines()[-1])
+        total = sum(int(match.group(1)) for match in IMPORTTIME_LINE.finditer(result.stderr)) / 1000
+        if best is None or total < best:
+            best = total
+    return best, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_imports(budgets=IMPORT_BUDGETS, repeat=3, factor=1.0, log=print):
+    """Measure every module in ``budgets`` and return a list of regressions."""
+    failures = []
+    for module, (budget, forbidden) in budgets.items():
+        try:
+            elapsed, packages = measure_import(module, repeat)
+        except ImportError as e:
+            failures.append(f"{module}: import failed ({e})")
+            log(f"{module:<28} FAILED")
+            continue
+        loaded = [package for package in forbidden if package in packages]
+        log(f"{module:<28} {elapsed:8.1f} ms (budget {budget*factor:.0f} ms)")
+        if elapsed > budget * factor:
+            failures.append(f"{module}: {elapsed:.1f} ms exceeds the budget of {budget*factor:.0f} ms")
+        if loaded:
+            failures.append(f"{module}: imports {', '.join(loaded)} at import time")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="topasdosecalc import-benchmark",
+        description="Check the import time of the TopasDoseCalc modules against their budgets.",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="imports per module, the fastest one counts")
+    parser.add_argument("--factor", type=float, default=1.0, help="multiply all time budgets, e.g. on slow machines")
+    args = parser.parse_args(argv)
+
+    failures = check_imports(repeat=args.repeat, factor=args.factor)
+    for failure in failures:
+        print(f"(ERROR) {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import threading
+import itertools
+import numpy as np
+
+UNIFORM_TOLERANCE = 1e-4  # relative to the grid spacing
+
+
+class UniformGridInterpolator:
+    """Multilinear interpolation on a grid with uniformly spaced axes.
+
+    A drop-in replacement for ``scipy.interpolate.RegularGridInterpolator``
+    with ``bounds_error=False`` for the gamma search. Because every axis is
+    uniform, the cell of a point is found with index arithmetic instead of a
+    ``searchsorted`` per axis. The values are kept in ``dtype`` (float32 by
+    default) and all intermediate arrays are scratch buffers that are reused
+    between calls of the same thread.
+
+    Parameters
+    ----------
+    axes : tuple
+        The coordinates of the grid points along each axis. Axes may be
+        ascending or descending.
+    values : np.ndarray
+        The values on the grid.
+    fill_value : float, optional
+        Value returned for points outside of the grid.
+    dtype : np.dtype, optional
+        Precision of the stored values and of the interpolated result.
+    """
+
+    def __init__(self, axes, values, fill_value=np.inf, dtype=np.float32):
+        values = np.asarray(values)
+        if values.ndim != len(axes):
+            raise ValueError(f"Got {len(axes)} axes for values with {values.ndim} dimensions")
+        origin, step, size, lower, upper = [], [], [], [], []
+        for i, axis in enumerate(axes):
+            axis = np.asarray(axis, dtype=np.float64)
+            if len(axis) != values.shape[i]:
+                raise ValueError(f"Axis {i} has {len(axis)} points but the values have {values.shape[i]}")
+            if not is_uniform(axis):
+                raise ValueError(f"Axis {i} is not uniformly spaced")
+            if len(axis) > 1 and axis[1] < axis[0]:
+                axis = axis[::-1]
+                values = np.flip(values, axis=i)
+            origin.append(axis[0])
+            lower.append(axis[0])
+            upper.append(axis[-1])
+            step.append((axis[-1] - axis[0]) / (len(axis) - 1) if len(axis) > 1 else 1.0)
+            size.append(len(axis))
+
+        self.dtype = np.dtype(dtype)
+        self.values = np.ascontiguousarray(values, dtype=self.dtype).ravel()
+        self.origin = np.array(origin)
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+        self.step = np.array(step)
+        self.size = np.array(size)
+        self.strides = np.array([int(np.prod(size[i + 1:])) for i in range(len(size))], dtype=np.int64)
+        self.fill_value = fill_value
+        self.local = threading.local()
+
+    @property
+    def ndim(self):
+        return len(self.size)
+
+    def scratch(self, name, size, dtype):
+        """Return a reusable buffer of at least ``size`` elements."""
+        buffers = self.local.__dict__.setdefault("buffers", {})
+        buffer = buffers.get(name)
+        if buffer is None or buffer.size < size:
+            buffer = buffers[name] = np.empty(size, dtype=dtype)
+        return buffer[:size]
+
+    def __call__(self, points, out=None):
+        """Interpolate at ``points`` of shape (..., ndim)."""
+        points = np.asarray(points)
+        return self.evaluate([points[..., i] for i in range(self.ndim)], out)
+
+    def evaluate(self, coordinates, out=None, offsets=None):
+        """Interpolate at the points given by one coordinate array per axis.
+
+        The coordinate arrays, and the ``offsets`` added to them if given, are
+        broadcast against each other, so a shell of offsets and a set of
+        reference points can be combined without materialising every point.
+
+        Returns
+        -------
+        np.ndarray
+            The interpolated values in ``out`` (which must be C-contiguous)
+            if given, otherwise in a new array of the broadcast shape.
+        """
+        shapes = [np.shape(c) for c in coordinates]
+        if offsets is not None:
+            shapes += [np.shape(o) for o in offsets]
+        shape = np.broadcast_shapes(*shapes)
+        n = int(np.prod(shape))
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        result = out.reshape(-1)
+
+        t = self.scratch("t", n, np.float64).reshape(shape)
+        fraction = self.scratch("fraction", self.ndim * n, self.dtype).reshape((self.ndim, n))
+        complement = self.scratch("complement", self.ndim * n, self.dtype).reshape((self.ndim, n))
+        base = self.scratch("base", n, np.int64)
+        index = self.scratch("index", n, np.int64)
+        cell = self.scratch("cell", n, np.int64)
+        outside = self.scratch("outside", n, bool)
+        flag = self.scratch("flag", n, bool).reshape(shape)
+        weight = self.scratch("weight", n, self.dtype)
+        value = self.scratch("value", n, self.dtype)
+
+        base[:] = 0
+        outside[:] = False
+        for i, coordinate in enumerate(coordinates):
+            if offsets is None:
+                np.copyto(t, coordinate)
+            else:
+                np.add(coordinate, offsets[i], out=t)
+
+            # Bounds are checked on the coordinates themselves, exactly as
+            # RegularGridInterpolator does.
+            np.less(t, self.lower[i], out=flag)
+            outside |= flag.reshape(-1)
+            np.greater(t, self.upper[i], out=flag)
+            outside |= flag.reshape(-1)
+            np.isnan(t, out=flag)
+            outside |= flag.reshape(-1)
+
+            # Position in units of grid cells. fmax/fmin also map NaN into the
+            # grid; such points are outside anyway.
+            np.subtract(t, self.origin[i], out=t)
+            np.multiply(t, 1 / self.step[i], out=t)
+            flat = t.reshape(-1)
+            np.fmax(flat, 0, out=flat)
+            np.fmin(flat, self.size[i] - 1, out=flat)
+            np.copyto(cell, flat, casting="unsafe")
+            np.minimum(cell, max(self.size[i] - 2, 0), out=cell)
+            np.subtract(flat, cell, out=fraction[i], casting="unsafe")
+            np.subtract(1, fraction[i], out=complement[i])
+            np.multiply(cell, self.strides[i], out=cell)
+            np.add(base, cell, out=base)
+
+        result[:] = 0
+        for corner in itertools.product((0, 1), repeat=self.ndim):
+            offset = 0
+            weight[:] = 1
+            for i, upper in enumerate(corner):
+                if upper:
+                    if self.size[i] == 1:
+                        break
+                    offset += self.strides[i]
+                    np.multiply(weight, fraction[i], out=weight)
+                else:
+                    np.multiply(weight, complement[i], out=weight)
+            else:
+                np.add(base, offset, out=index)
+                np.take(self.values, index, out=value)
+                np.multiply(weight, value, out=value)
+                np.add(result, value, out=result)
+
+        result[outside] = self.fill_value
+        return out
+
+
+def is_uniform(axis):
+    """Whether the points of an axis are equally spaced."""
+    axis = np.asarray(axis, dtype=np.float64)
+    if len(axis) < 3:
+        return len(axis) < 2 or axis[1] != axis[0]
+    diff = np.diff(axis)
+    step = (axis[-1] - axis[0]) / (len(axis) - 1)
+    return step != 0 and np.all(np.abs(diff - step) <= UNIFORM_TOLERANCE * abs(step))
+
+
+def make_interpolator(axes, values, fill_value=np.inf, dtype=np.float32):
+    """Return a UniformGridInterpolator, or a RegularGridInterpolator if any
+    of the axes is not uniformly spaced."""
+    if all(is_uniform(axis) for axis in axes):
+        return UniformGridInterpolator(axes, values, fill_value=fill_value, dtype=dtype)
+
+    from scipy.interpolate import RegularGridInterpolator
+
+    return RegularGridInterpolator(axes, np.array(values), bounds_error=False, fill_value=fill_value)
@@ -0,0 +1,52 @@
+import hashlib
+import numpy as np
+from .disk_cache import DiskCache
+
+MASK_CACHE_SIZE = 64
+MASK_QUANTUM = 1e-3  # mm
+
+
+class MaskCache(DiskCache):
+    """LRU cache of rasterised structure masks.
+
+    A mask only depends on the RTSTRUCT, the ROI and the grid it is
+    rasterised on, so the reference and evaluation doses of a gamma
+    calculation and the DVHs of the same structure can share it. Grid
+    coordinates are quantized to ``MASK_QUANTUM`` for the key. If
+    ``directory`` is given, masks are also stored there as packed bits and
+    read back instead of being rasterised again.
+    """
+
+    def __init__(self, maxsize=MASK_CACHE_SIZE, directory=None):
+        super().__init__(maxsize, directory)
+
+    @staticmethod
+    def key(rtstruct_uid, roi_number, axes, settings=()):
+        """Return the key of the mask of ROI ``roi_number`` of an RTSTRUCT
+        on the grid with the given ``axes``. ``settings`` holds any further
+        parameters the rasterisation depends on."""
+        digest = hashlib.sha1()
+        for axis in axes:
+            digest.update(np.round(np.asarray(axis, dtype=float) / MASK_QUANTUM).astype(np.int64).tobytes())
+            digest.update(b"|")
+        digest.update(repr(tuple(settings)).encode())
+        return (str(rtstruct_uid), int(roi_number), digest.hexdigest())
+
+    def get(self, key, rasterise):
+        """Return the mask for ``key`` as a read-only boolean array, calling
+        ``rasterise()`` to create it if it is not cached."""
+        return self.lookup(key, lambda: np.asarray(rasterise(), dtype=bool))
+
+    def filename(self, key):
+        return f"mask_{hashlib.sha1(repr(key).encode()).hexdigest()}.npz"
+
+    def read(self, path, key):
+        with np.load(path) as data:
+            shape = tuple(data["shape"])
+            return np.unpackbits(data["bits"], count=int(np.prod(shape))).astype(bool).reshape(shape)
+
+    def write(self, file, mask):
+        np.savez(file, bits=np.packbits(mask.ravel()), shape=np.array(mask.shape, dtype=np.int64))
+
+
+MASK_CACHE = MaskCache()
@@ -0,0 +1,414 @@
+import os
+import json
+import uuid
+import itertools
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pydicom import dcmread
+from .dose_volume import read_dose_volume
+from .dicom_index import DoseFileHeader
+
+# Number of files summed per block. The block layout and the reduction tree
+# only depend on this and the number of files, never on the worker count.
+MERGE_BLOCK_SIZE = 8
+
+MERGE_STATE_MANIFEST = "manifest.json"
+MERGE_STATE_VERSION = 3
+
+
+def collect_dose_files(folder, include_subdirectories, description):
+    """Find the control point RTDOSE files and isocenter CSVs in a folder.
+
+    Outputs of a previous merge with the same description (merged RTDOSE,
+    merged isocenter CSV and the incremental merge state) are skipped.
+
+    Returns
+    -------
+    tuple
+        Lists of the RTDOSE and the CSV file paths.
+    """
+    outputs = {f"{description}.dcm", f"{description}_iso.csv"}
+    files = []
+    iso_files = []
+    for root, dirs, filenames in os.walk(folder):
+        if root == folder:
+            dirs[:] = [d for d in dirs if d != f"{description}_merge"]
+            filenames = [file for file in filenames if file not in outputs]
+        for file in filenames:
+            if file.endswith(".dcm"):
+                files.append(os.path.join(root, file))
+            elif file.endswith(".csv"):
+                iso_files.append(os.path.join(root, file))
+        if not include_subdirectories:
+            break
+    return files, iso_files
+
+
+def merge_dose(files, scales, progress=None, workers=1):
+    """Sum the scaled dose of several RTDOSE files.
+
+    The files are split into fixed blocks of ``MERGE_BLOCK_SIZE``. Each block
+    is streamed into a single preallocated accumulator, in the calling
+    process or in a worker process, and the block sums are combined with a
+    pairwise tree reduction. Because the block layout and the tree shape are
+    fixed, the result is bitwise identical for any number of workers. In
+    serial mode peak memory is two volumes plus one partial sum per level of
+    the tree; with several workers at most two blocks per worker are in
+    flight, which adds about ``2 * workers`` partial sums.
+
+    Parameters
+    ----------
+    files : list
+        Paths or DoseFileHeader index entries of the RTDOSE files, in control
+        point order. Index entries are memory-mapped without reparsing.
+    scales : list
+        Combined scale factor for each file (reference scale, histories ratio,
+        MU weight, fractions). Files with a scale of 0 are skipped.
+    progress : callable, optional
+        Called with the completed fraction after each block.
+    workers : int, optional
+        Number of processes decoding blocks in parallel. Defaults to 1, which
+        merges in the calling process.
+
+    Returns
+    -------
+    np.ndarray
+        The merged dose in Gy as a float64 array, or None if every scale was 0.
+    """
+    return _merge_blocks(files, scales, progress, workers)
+
+
+def _merge_blocks(files, scales, progress, workers, snapshots=None):
+    """The block merge of :func:`merge_dose`. If ``snapshots`` is given, the
+    stored values of every file with a path in it are written there while
+    the file is read."""
+    if snapshots is None:
+        snapshots = [None] * len(files)
+    blocks = [
+        (files[i:i + MERGE_BLOCK_SIZE], scales[i:i + MERGE_BLOCK_SIZE], snapshots[i:i + MERGE_BLOCK_SIZE])
+        for i in range(0, len(files), MERGE_BLOCK_SIZE)
+    ]
+
+    def report(done):
+        if progress is not None:
+            progress(done / len(blocks))
+
+    def partials():
+        for done, partial in enumerate(_block_sums(blocks, workers), 1):
+            report(done)
+            yield partial
+
+    return _reduce_tree(partials())
+
+
+def _block_sums(blocks, workers):
+    """Yield the sum of every (files, scales, snapshots) block in order.
+
+    Blocks are summed by a process pool if ``workers`` is above 1. The next
+    block is only submitted when a partial sum is consumed, so at most two
+    blocks per worker are in flight, and each finished future is released so
+    its partial sum can be freed as soon as the caller is done with it.
+    """
+    if workers is None or workers <= 1:
+        for block in blocks:
+            yield _sum_block(*block)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(blocks))) as executor:
+        remaining = iter(blocks)
+        futures = deque(executor.submit(_sum_block, *block) for block in itertools.islice(remaining, 2 * workers))
+        while futures:
+            partial = futures.popleft().result()
+            for block in itertools.islice(remaining, 1):
+                futures.append(executor.submit(_sum_block, *block))
+            yield partial
+
+
+def _sum_block(files, scales, snapshots=None):
+    """Accumulate one block of files in place. Runs in the worker processes,
+    or in the calling process for a serial merge."""
+    data = None
+    scratch = None
+    for file, scale, snapshot in zip(files, scales, snapshots or [None] * len(files)):
+        if scale == 0:
+            continue
+        volume = file.open() if isinstance(file, DoseFileHeader) else read_dose_volume(file)
+        if snapshot is not None:
+            _save_snapshot(snapshot, volume)
+        if data is None:
+            data = np.zeros(volume.shape, dtype=np.float64)
+            scratch = np.empty_like(data)
+        np.multiply(volume.pixels, float(scale) * volume.scaling, out=scratch)
+        np.add(data, scratch, out=data)
+        del volume
+    return data
+
+
+def _add_partials(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    return np.add(left, right, out=left)
+
+
+def _reduce_tree(partials):
+    """Pairwise reduction of an ordered stream of partial sums.
+
+    Partials are merged like a binary counter, so only O(log n) of them are
+    held at once and the tree shape depends solely on their number.
+    """
+    stack = []
+    for partial in partials:
+        level = 0
+        while stack and stack[-1][0] == level:
+            partial = _add_partials(stack.pop()[1], partial)
+            level += 1
+        stack.append((level, partial))
+
+    result = None
+    while stack:
+        result = _add_partials(stack.pop()[1], result)
+    return result
+
+
+def incremental_merge(files, scales, state_dir, progress=None, workers=1):
+    """Merge like :func:`merge_dose`, reusing the result of a previous merge.
+
+    The accumulator, a fingerprint (SOP Instance UID, size and mtime) and the
+    scale of every file, and a snapshot of the stored values (PixelData and
+    DoseGridScaling, compressed) of every contributing file are kept in
+    ``state_dir``. On the next call only files whose fingerprint or scale
+    changed are read: the stale contribution of a changed file is subtracted
+    using its snapshot and the new one is added, so re-merging after a single
+    control point was re-simulated costs two reads, and a file whose scale
+    changed is read once. As in the ``DoseIndex``, files are recognised as
+    changed by their UID, size and mtime, so an edit that keeps all three is
+    not detected. If there is no usable state, or most files changed, a full
+    merge is done instead, which reads every file once and is bitwise
+    identical to :func:`merge_dose`.
+
+    Results of incremental updates can differ from a full merge in the last
+    bits due to the different summation order.
+
+    Parameters
+    ----------
+    files : list
+        Paths or DoseFileHeader index entries of the RTDOSE files.
+    scales : list
+        Combined scale factor for each file, see :func:`merge_dose`.
+    state_dir : str
+        Directory holding the merge state, usually next to the output file.
+    progress : callable, optional
+        Called with the completed fraction.
+    workers : int, optional
+        Number of processes used if a full merge is needed.
+
+    Returns
+    -------
+    np.ndarray
+        The merged dose in Gy as a float64 array, or None if every scale was 0.
+    """
+    headers = [file if isinstance(file, DoseFileHeader) else DoseFileHeader.read(file) for file in files]
+    current = {header.path: {"fingerprint": _fingerprint(header), "scale": float(scale)} for header, scale in zip(headers, scales)}
+    manifest = _load_merge_state(state_dir, headers)
+    os.makedirs(state_dir, exist_ok=True)
+
+    if manifest is not None:
+        previous = manifest["files"]
+        stale = {path for path, entry in previous.items() if path not in current or entry["fingerprint"] != current[path]["fingerprint"]}
+        fresh = [header for header in headers if header.path not in previous or header.path in stale]
+        rescaled = [
+            header for header in headers
+            if header.path in previous and header.path not in stale and previous[header.path]["scale"] != current[header.path]["scale"]
+        ]
+        if len(stale) + len(fresh) + len(rescaled) >= len(headers):
+            manifest = None
+        elif not stale and not fresh and not rescaled:
+            return np.load(os.path.join(state_dir, manifest["accumulator"]))
+
+    if manifest is None:
+        snapshots = {header.path: _snapshot_name() if current[header.path]["scale"] != 0 else None for header in headers}
+        paths = [None if snapshots[header.path] is None else os.path.join(state_dir, snapshots[header.path]) for header in headers]
+        data = _merge_blocks(headers, [float(scale) for scale in scales], progress, workers, paths)
+    else:
+        data = np.load(os.path.join(state_dir, manifest["accumulator"]))
+        scratch = np.empty_like(data)
+        snapshots = {path: entry["snapshot"] for path, entry in previous.items() if path not in stale}
+        steps = len(stale) + len(fresh) + len(rescaled)
+        done = 0
+
+        def report():
+            if progress is not None:
+                progress(done / steps)
+
+        for path in stale:
+            entry = previous[path]
+            if entry["snapshot"] is not None:
+                with np.load(os.path.join(state_dir, entry["snapshot"])) as snapshot:
+                    np.multiply(snapshot["pixels"], entry["scale"] * float(snapshot["scaling"]), out=scratch)
+                np.subtract(data, scratch, out=data)
+            done += 1
+            report()
+        for header in rescaled:
+            old, new = previous[header.path]["scale"], current[header.path]["scale"]
+            volume = header.open()
+            np.multiply(volume.pixels, (new - old) * volume.scaling, out=scratch)
+            np.add(data, scratch, out=data)
+            if snapshots[header.path] is None and new != 0:
+                snapshots[header.path] = _snapshot_name()
+                _save_snapshot(os.path.join(state_dir, snapshots[header.path]), volume)
+            del volume
+            done += 1
+            report()
+        for header in fresh:
+            scale = current[header.path]["scale"]
+            snapshots[header.path] = None
+            if scale != 0:
+                volume = header.open()
+                np.multiply(volume.pixels, scale * volume.scaling, out=scratch)
+                np.add(data, scratch, out=data)
+                snapshots[header.path] = _snapshot_name()
+                _save_snapshot(os.path.join(state_dir, snapshots[header.path]), volume)
+                del volume
+            done += 1
+            report()
+        del scratch
+
+    if data is not None:
+        entries = {path: dict(entry, snapshot=snapshots[path]) for path, entry in current.items()}
+        _save_merge_state(state_dir, data, entries)
+    return data
+
+
+def _fingerprint(header):
+    return f"{header.sop_instance_uid}:{header.size}:{header.mtime_ns}"
+
+
+def _snapshot_name():
+    return f"snapshot_{uuid.uuid4().hex}.npz"
+
+
+def _save_snapshot(path, volume):
+    """Store the PixelData and DoseGridScaling of a file, compressed."""
+    np.savez_compressed(path, pixels=np.asarray(volume.pixels), scaling=volume.scaling)
+
+
+def _load_merge_state(state_dir, headers):
+    """Return the manifest of a previous merge if it can be continued."""
+    try:
+        with open(os.path.join(state_dir, MERGE_STATE_MANIFEST), "r") as file:
+            manifest = json.load(file)
+        if manifest.get("version") != MERGE_STATE_VERSION:
+            return None
+        if headers and tuple(manifest["shape"]) != tuple(headers[0].shape):
+            return None
+        names = [manifest["accumulator"]] + [entry["snapshot"] for entry in manifest["files"].values() if entry["snapshot"] is not None]
+        if not all(os.path.isfile(os.path.join(state_dir, name)) for name in names):
+            return None
+        return manifest
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_merge_state(state_dir, data, entries):
+    """Write accumulator and manifest of a merge and remove unused files.
+
+    Snapshots and the accumulator get new names and the manifest is
+    replaced atomically last, so an interrupted update leaves the previous
+    state intact.
+    """
+    accumulator = f"accumulator_{uuid.uuid4().hex}.npy"
+    np.save(os.path.join(state_dir, accumulator), data)
+
+    manifest = {
+        "version": MERGE_STATE_VERSION,
+        "shape": list(data.shape),
+        "accumulator": accumulator,
+        "files": entries,
+    }
+    temporary = os.path.join(state_dir, MERGE_STATE_MANIFEST + ".tmp")
+    with open(temporary, "w") as file:
+        json.dump(manifest, file)
+    os.replace(temporary, os.path.join(state_dir, MERGE_STATE_MANIFEST))
+
+    referenced = {accumulator} | {entry["snapshot"] for entry in entries.values()}
+    for name in os.listdir(state_dir):
+        if name.startswith(("accumulator_", "block_", "snapshot_")) and name not in referenced:
+            try:
+                os.remove(os.path.join(state_dir, name))
+            except OSError:
+                pass
+
+
+def write_merged_dose(template, data, path, description):
+    """Store a merged dose volume using the header of a template RTDOSE file.
+
+    The dose is requantised to uint32 with a new DoseGridScaling. ``data`` is
+    rescaled in place to avoid allocating another float volume.
+    """
+    with dcmread(template) as ds:
+        ds.DoseGridScaling = np.max(data) / (2 ** int(ds.HighBit))
+        np.divide(data, ds.DoseGridScaling, out=data)
+        ds.PixelData = data.astype(np.uint32).tobytes()
+        ds.SeriesDescription = description
+        ds.save_as(path)
+
+
+def read_iso_csv(path, scale):
+    """Read the bins of a TOPAS isocenter scorer CSV.
+
+    Returns an array of shape (bins, 5) with the columns Sum, Standard
+    Deviation, Histories with Scorer Active, Count in Bin and Max, where the
+    dose columns are multiplied by ``scale``.
+    """
+    data = np.loadtxt(path, delimiter=",", skiprows=9, usecols=(3, 4, 5, 6, 7), ndmin=2)
+    data[:, [0, 1, 4]] *= scale
+    return data
+
+
+def merge_iso_files(files, scales, progress=None):
+    """Combine the isocenter scorer CSVs of all control points.
+
+    All files are stacked into one (files, bins, 5) array and reduced along
+    the file axis: positive sums are added, positive standard deviations are
+    combined in quadrature and divided by the square root of the number of
+    files, histories and counts are added and the maximum of the sums is kept.
+    Files with a scale of 0 are skipped.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (bins, 5) in the column order of :func:`read_iso_csv`.
+    """
+    used = [(file, scale) for file, scale in zip(files, scales) if scale != 0]
+    data = np.empty((0, 0, 5))
+    for i, (file, scale) in enumerate(used):
+        bins = read_iso_csv(file, scale)
+        if i == 0:
+            data = np.empty((len(used),) + bins.shape)
+        data[i] = bins
+        if progress is not None:
+            progress((i + 1) / len(used))
+
+    dose = np.clip(data[:, :, 0], 0, None).sum(axis=0)
+    std_dev = np.sqrt(np.square(np.clip(data[:, :, 1], 0, None)).sum(axis=0)) / np.sqrt(len(used))
+    n_hist = data[:, :, 2].sum(axis=0)
+    count_in_bin = data[:, :, 3].sum(axis=0)
+    max_dose = data[:, :, 0].max(axis=0)
+    return np.column_stack((dose, std_dev, n_hist, count_in_bin, max_dose))
+
+
+def iso_summary(data):
+    """Return the mean dose, the statistical accuracy and the mean count of
+    a merged isocenter array from :func:`merge_iso_files`."""
+    dose, std_dev, n_hist, count_in_bin = data[:, 0], data[:, 1], data[:, 2], data[:, 3]
+    dose_to_isocenter = np.average(dose)
+    statistical_accuracy = np.average(std_dev / dose) * np.average(np.sqrt(n_hist))
+    return dose_to_isocenter, statistical_accuracy, np.average(count_in_bin)
+
+
+def write_iso_csv(path, data):
+    with open(path, "w") as file:
+        np.savetxt(file, data, delimiter=",", header="Sum\tStandard_Deviation\tHistories_with_Scorer_Active\tCount_in_Bin\tMax", comments="", fmt='%1.4e\t%1.4e\t%1.0f\t%1.0f\t%1.4e')
@@ -2,15 +2,59 @@ import os
 import numpy as np
 from PIL import Image
 import customtkinter as ctk
-from pydicom import dcmread
 from threading import Thread
+from dataclasses import dataclass
+from typing import Optional
 from .mu_sequence import MU_Sequence
+from .merge import collect_dose_files, merge_dose, incremental_merge, write_merged_dose, merge_iso_files, iso_summary, write_iso_csv
+from .dicom_index import DoseIndex
+from .rtplan import read_plan, mu_sequence, random_interpolation_same_sum
 from .structure_selector import StructureSelector
-from .gamma import crop_dose_to_roi, gamma
+from .dvh import DVH_WORKERS
 from tkinter.filedialog import askdirectory, askopenfilename
 from natsort import natsorted
-from mlca.mlc_analyzer import Plan
-import hashlib
+
+@dataclass(frozen=True)
+class GammaSettings:
+    """Gamma options read from the Gamma tab."""
+    roi_number: int
+    roi_name: str
+    criteria: list
+    criteria_text: str
+    gamma_types: list
+    lower_percent_dose_cutoff: int
+    workers: int
+
+
+@dataclass(frozen=True)
+class MergeSettings:
+    """Everything the merge pipeline needs from the GUI.
+
+    It is read on the Tk thread when the merge is started, so the worker
+    thread never touches a widget or Tk variable.
+    """
+    folder: str
+    description: str
+    include_subdirectories: bool
+    histories: float
+    mus: Optional[float]
+    reference_mus: float
+    reference_histories: float
+    reference_scale: float
+    sequence: list
+    fractions: int
+    dose: Optional[float]
+    workers: int
+    dvh_workers: int
+    incremental: bool
+    merge_iso: bool
+    dvh: bool
+    rtstruct: str
+    rtdose: str
+    structures: list
+    selected_structures: list
+    gamma: Optional[GammaSettings]
+
 
 class Options(ctk.CTkTabview):
     def __init__(self, parent):
@@ -19,6 +63,7 @@ class Options(ctk.CTkTabview):
         self.resource_path = self.parent.resource_path
         self.sequence = []
         self.fractions = 1
+        self.merging = False
         super().__init__(parent, border_color="black", border_width=1)
         
         self.add("General")
@@ -30,7 +75,7 @@ class Options(ctk.CTkTabview):
         self.init_tab2()
         self.init_tab3()
         self.init_tab4()
-        self.check_buttons()
+        self.watch_inputs()
          
     def init_tab1(self):
         ### TAB 1 ###
@@ -42,20 +87,23 @@ class Options(ctk.CTkTabview):
         
         self.folderlabel = ctk.CTkLabel(self.tab("General"), text="1. Select the directory containing the DICOM dose files", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
         self.folderimage = ctk.CTkImage(dark_image=Image.open(self.resource_path(os.path.join("src","images","folder.png"))), size=(32,32))
-        self.foldercheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30)
+        self.foldercheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, variable=ctk.BooleanVar(self, value=False))
         self.subdircheckbox = ctk.CTkCheckBox(self.tab("General"), text="Include subdirectories", width=20)
+        self.merge_workers = ctk.StringVar(value="1")
+        self.merge_workers_label = ctk.CTkLabel(self.tab("General"), text="Worker Processes", font=("Bahnschrift",12), fg_color="#2B2B2B", anchor="e")
+        self.merge_workers_entry = ctk.CTkEntry(self.tab("General"), width=60, textvariable=self.merge_workers)
         self.folder = ctk.StringVar()
         self.select_folder_button = ctk.CTkButton(self.tab("General"), text="Select Folder", image=self.folderimage, compound="left", command=self.select_folder)
         
         self.historieslabel = ctk.CTkLabel(self.tab("General"), text="2. Input the histories used for the simulations", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
         self.histories = ctk.StringVar()
-        self.historycheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30)
+        self.historycheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, variable=ctk.BooleanVar(self, value=False))
         self.histories_entry = ctk.CTkEntry(self.tab("General"), width=140, textvariable=self.histories)
         self.histories_entry.bind("<Return>", lambda event: self.entry_callback(event, self.histories_entry, self.historycheckbox, "simulation histories"))
         
         self.mus_label = ctk.CTkLabel(self.tab("General"), text="3. Input the monitor units of the simulated sequence", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
         self.mus = ctk.StringVar()
-        self.mus_checkbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, command = self.toggle_mus)
+        self.mus_checkbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, command = self.toggle_mus, variable=ctk.BooleanVar(self, value=False))
         self.mus_entry = ctk.CTkEntry(self.tab("General"), width=140, textvariable=self.mus)
         self.mus_entry.bind("<Return>", lambda event: self.entry_callback(event, self.mus_entry, self.mus_checkbox, "simulation monitor units"))
         
@@ -63,7 +111,7 @@ class Options(ctk.CTkTabview):
         self.reference_mus = ctk.StringVar(value="100")
         self.reference_histories = ctk.StringVar(value="500000000")
         self.reference_scale = ctk.StringVar(value="973375")
-        self.reference_checkbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30)
+        self.reference_checkbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, variable=ctk.BooleanVar(self, value=False))
 
         self.reference_mus_label = ctk.CTkLabel(self.tab("General"), text="Reference Monitor Units", font=("Bahnschrift",12), fg_color="#2B2B2B", anchor="center")
         self.reference_mus_entry = ctk.CTkEntry(self.tab("General"), width=120, textvariable=self.reference_mus)
@@ -76,16 +124,18 @@ class Options(ctk.CTkTabview):
         self.reference_scale_entry.bind("<Return>", lambda event: self.entry_callback_2(event, self.reference_scale_entry, "reference scale factor"))
         
         self.descriptionlabel = ctk.CTkLabel(self.tab("General"), text="5. Enter a new series description", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
-        self.descriptioncheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30)
+        self.descriptioncheckbox = ctk.CTkCheckBox(self.tab("General"), state="disabled", text="", width=30, variable=ctk.BooleanVar(self, value=False))
         self.descriptionentry = ctk.CTkEntry(self.tab("General"), width=200)
         self.descriptionentry.bind("<Return>", lambda event: self.descriptioncheckbox.select())
         
-        self.merge_button = ctk.CTkButton(self.tab("General"), text="Merge Dose Files", command=lambda: Thread(target=self.merge_dose_files).start(), state="disabled")
+        self.merge_button = ctk.CTkButton(self.tab("General"), text="Merge Dose Files", command=self.start_merge, state="disabled")
         
         self.folderlabel.grid(row=0, column=1, columnspan=3, sticky="nsew", padx=5, pady=1)
         self.foldercheckbox.grid(row=0, column=0, sticky="w", padx=10, pady=1)
         self.select_folder_button.grid(row=1, column=1, columnspan=3, sticky="w", padx=5, pady=1)
-        self.subdircheckbox.grid(row=2, column=1, columnspan=3,sticky="w", padx=5, pady=(5,1))
+        self.subdircheckbox.grid(row=2, column=1, sticky="w", padx=5, pady=(5,1))
+        self.merge_workers_label.grid(row=2, column=2, sticky="e", padx=5, pady=(5,1))
+        self.merge_workers_entry.grid(row=2, column=3, sticky="w", padx=5, pady=(5,1))
         
         self.historieslabel.grid(row=3, column=1, columnspan=3, sticky="nsew", padx=5, pady=1)
         self.historycheckbox.grid(row=3, column=0, sticky="w", padx=10, pady=1)
@@ -110,8 +160,24 @@ class Options(ctk.CTkTabview):
         
         self.merge_button.grid(row=12, column=0, columnspan=4, sticky="ns", padx=5, pady=1)
         
+    def watch_inputs(self):
+        # The merge button follows the checkboxes of the required inputs
+        # instead of polling them
+        for checkbox in (
+            self.foldercheckbox,
+            self.historycheckbox,
+            self.mus_checkbox,
+            self.reference_checkbox,
+            self.descriptioncheckbox,
+            self.rtplan_checkbox,
+        ):
+            checkbox.cget("variable").trace_add("write", lambda *args: self.check_buttons())
+        self.check_buttons()
+        
     def check_buttons(self):
-        if  (self.foldercheckbox._check_state == True and\
+        if self.merging:
+            self.merge_button.configure(state="disabled")
+        elif (self.foldercheckbox._check_state == True and\
             self.historycheckbox._check_state == True and\
             self.reference_checkbox._check_state == True and\
             self.descriptioncheckbox._check_state == True) and \
@@ -122,8 +188,80 @@ class Options(ctk.CTkTabview):
                 self.merge_button.configure(state="normal") 
         else:
             self.merge_button.configure(state="disabled")
+        
+    def start_merge(self):
+        try:
+            settings = self.merge_settings()
+        except ValueError as e:
+            self.log(f"(ERROR) {e}")
+            return
+        self.merging = True
+        self.check_buttons()
+        Thread(target=self.run_merge, args=(settings,), daemon=True).start()
+        
+    def merge_settings(self):
+        """Read the options of all tabs into a MergeSettings."""
+        try:
+            workers = max(1, int(self.merge_workers.get()))
+        except ValueError:
+            workers = 1
+            self.log("Invalid number of worker processes, merging serially")
+        try:
+            dvh_workers = max(1, int(self.dvh_workers.get()))
+        except ValueError:
+            dvh_workers = 1
+            self.log("Invalid number of DVH worker processes, calculating the DVHs serially")
+        try:
+            histories = float(self.histories.get())
+            mus = float(self.mus.get()) if self.mus_checkbox._check_state == True else None
+            reference_mus = float(self.reference_mus.get())
+            reference_histories = float(self.reference_histories.get())
+            reference_scale = float(self.reference_scale.get())
+        except ValueError:
+            raise ValueError("Invalid histories, monitor units or reference values")
+        structures = getattr(self.structures, "structures", [])
+        if self.dvh.get() and (getattr(self, "dose", None) is None or getattr(self, "rtstruct", "") == ""):
+            raise ValueError("DVH calculations need an RTSTRUCT and the prescription of an RTPLAN")
+        return MergeSettings(
+            folder=self.folder.get(),
+            description=self.descriptionentry.get(),
+            include_subdirectories=self.subdircheckbox._check_state == True,
+            histories=histories,
+            mus=mus,
+            reference_mus=reference_mus,
+            reference_histories=reference_histories,
+            reference_scale=reference_scale,
+            sequence=list(self.sequence),
+            fractions=self.fractions,
+            dose=getattr(self, "dose", None),
+            workers=workers,
+            dvh_workers=dvh_workers,
+            incremental=self.incremental.get(),
+            merge_iso=self.mergeiso.get(),
+            dvh=self.dvh.get(),
+            rtstruct=getattr(self, "rtstruct", ""),
+            rtdose=self.rtdose,
+            structures=list(structures),
+            selected_structures=self.structures.selected_structures() if self.dvh.get() else [],
+            gamma=self.gamma_settings() if self.gamma.get() else None,
+        )
+        
+    def run_merge(self, settings):
+        try:
+            pending = self.merge_dose_files(settings)
+        except Exception as e:
+            self.log(f"(ERROR) {e}")
+            self.parent.post(self.merge_done, False)
+            return
+        if not pending:
+            self.parent.post(self.merge_done, True)
             
-        self.after(500, self.check_buttons)
+    def merge_done(self, complete):
+        if complete:
+            self.log("Merging complete. Done!")
+        self.merging = False
+        self.merge_button.configure(state="normal")
+        self.check_buttons()
         
     def select_folder(self):
         self.folder.set(askdirectory())
@@ -175,137 +313,68 @@ class Options(ctk.CTkTabview):
             self.reference_checkbox.configure(state="disabled")
 
             
-    def merge_dose_files(self):
-        files = []
-        iso_files = []
-        if self.subdircheckbox._check_state == True:
-            for root, dirs, files in os.walk(self.folder.get()):
-                for file in files:
-                    if file.endswith(".dcm"):
-                        files.append(os.path.join(root, file))
-                    elif file.endswith(".csv"):
-                        iso_files.append(os.path.join(root, file))
-        else:
-            for file in os.listdir(self.folder.get()):
-                if file.endswith(".dcm"):
-                    files.append(os.path.join(self.folder.get(), file))  
-                elif file.endswith(".csv"):
-                    iso_files.append(os.path.join(self.folder.get(), file))
+    def merge_dose_files(self, settings):
+        """Run the merge pipeline on a worker thread. Returns True if the
+        DVHs are still being calculated, which then call ``merge_done``."""
+        description = settings.description.strip()
+        files, iso_files = collect_dose_files(settings.folder, settings.include_subdirectories, description)
                     
         if len(files) == 0:
-            self.log("No dose files found in selected folder")
-            return
-        else:
-            self.log(f"Found {len(files)} dose files in selected folder")
-            
-            if self.mergeiso.get() == True:
-                self.log(f"Found {len(iso_files)} isocenter files in selected folder")
-            
-            if self.mus_checkbox._check_state == False:
-                if len(files) != len(self.sequence ):
-                    self.log("Number of dose files does not match number of control points. Trying to merge individual fields...")
-                    
-                    try:
-                        sort_string = "Field_"
-                        fields = len(self.sequence)
-                        fields_to_merge = [[] for i in range(fields)]
-                        for file in files:
-                            for i in range(fields):
-                                if sort_string + str(i) in file:
-                                    fields_to_merge[i].append(file) 
-                    except Exception as e:
-                        print(e)
-                        return
-                    
-                    ####MERGE FIELDS; UPDATE FILES LIST AND CONTINUE####
+            raise ValueError("No dose files found in selected folder")
+        self.log(f"Found {len(files)} dose files in selected folder")
+        
+        if settings.merge_iso:
+            self.log(f"Found {len(iso_files)} isocenter files in selected folder")
+        
+        index = DoseIndex.build(settings.folder, files, progress=self.parent.progress)
+        self.parent.progress(0)
+        index.check_grids()
+        
+        if settings.mus is None and len(files) != len(settings.sequence):
+            raise ValueError(f"Number of dose files ({len(files)}) does not match number of control points ({len(settings.sequence)})")
         
         self.log("Merging dose files...")
-        flag = 0
-        
-        for i,file in enumerate(natsorted(files)):
-            self.parent.pbvar.set((i+1)/len(files))
-            if self.sequence[i] != 0:
-                ds = dcmread(file)
-                if flag == 0:
-                    data = ds.pixel_array * ds.DoseGridScaling
-                    data *= float(self.reference_scale_entry.get()) * (float(self.reference_histories_entry.get()) / float(self.histories_entry.get()))
-                    if self.mus_checkbox._check_state == False:
-                        data *= (float(self.sequence [i]) / float(self.reference_mus_entry.get()))
-                    flag = 1
-                else:
-                    newdata = ds.pixel_array * ds.DoseGridScaling
-                    newdata *= float(self.reference_scale_entry.get()) * (float(self.reference_histories_entry.get()) / float(self.histories_entry.get()))
-                    if self.mus_checkbox._check_state == False:
-
-                        newdata *= (float(self.sequence [i]) / float(self.reference_mus_entry.get()))
-
-                    data = np.add(data, newdata)
-        data *= self.fractions
-        with dcmread(file) as ds:
-            if self.mus_checkbox._check_state == True:
-                data *= (float(self.mus_entry.get()) / float(self.reference_mus_entry.get()))
-
-            ds.DoseGridScaling = np.max(data) / (2 ** int(ds.HighBit))
-            data = (data / ds.DoseGridScaling).astype(np.uint32)
-            ds.PixelData = data.tobytes()
-            ds.SeriesDescription = self.descriptionentry.get()
-            ds.save_as(os.path.join(self.folder.get(), f"{self.descriptionentry.get().strip()}.dcm"))
-            self.log(f"Saved merged dose file to {os.path.join(self.folder.get(), f'{self.descriptionentry.get().strip()}.dcm')}")
-        self.parent.pbvar.set(0)
-        
-        if self.mergeiso.get() == True and len(iso_files) == len(self.sequence ):
+        files = index.headers
+        scale = settings.reference_scale * (settings.reference_histories / settings.histories) * settings.fractions
+        if settings.mus is not None:
+            scales = [scale * settings.mus / settings.reference_mus] * len(files)
+        else:
+            scales = [scale * float(settings.sequence[index.control_point(header.path)]) / settings.reference_mus for header in files]
+        output = os.path.join(settings.folder, f"{description}.dcm")
+        if settings.incremental:
+            data = incremental_merge(files, scales, f"{os.path.splitext(output)[0]}_merge", progress=self.parent.progress, workers=settings.workers)
+        else:
+            data = merge_dose(files, scales, progress=self.parent.progress, workers=settings.workers)
+        if data is None:
+            raise ValueError("Every weight is 0, there is no dose to merge")
+        write_merged_dose(files[-1].path, data, output, settings.description)
+        del data
+        self.log(f"Saved merged dose file to {output}")
+        self.parent.progress(0)
+        
+        if settings.merge_iso and len(iso_files) == len(settings.sequence):
             self.log("Merging isocenter data...")
-            data = []
-            for i,file in enumerate(natsorted(iso_files)):
-                if self.sequence [i] == 0:
-                    continue
-                self.parent.pbvar.set((i+1)/len(iso_files))
-                scale =  float(self.reference_scale_entry.get()) * (float(self.reference_histories_entry.get()) / float(self.histories_entry.get())) * float(self.sequence [i]) / float(self.reference_mus_entry.get())
-                data += [self.read_iso_csv(file, scale)]
-            self.parent.pbvar.set(0)
-            dose = []
-            std_dev = []
-            n_hist = []
-            count_in_bin = []
-            max_dose = []
-            for i in range(len(data[0])):
-                self.parent.pbvar.set((i+1)/len(data[0]))
-                dose += [(a:= sum([data[j][i][0] if data[j][i][0] > 0 else 0 for j in range(len(data))])  )]
-                std_dev += [ np.sqrt(sum([data[j][i][1]**2 if data[j][i][1] > 0 else 0  for j in range(len(data))])) * 1/(np.sqrt(len(data)))]
-                n_hist += [ sum([data[j][i][2] for j in range(len(data))])  ]
-                count_in_bin +=  [sum([data[j][i][3] for j in range(len(data))])  ]
-                max_dose += [ max([data[j][i][0] for j in range(len(data))])  ]
-            data  = np.column_stack((dose, std_dev, n_hist, count_in_bin, max_dose)) 
-
-            dose_to_isocenter = np.average(dose)
-            statistical_accuracy = np.average([1/dose[i] * std_dev[i] * np.sqrt(n_hist) for i in range(len(dose))])
-            self.log(f"Dose to reference point: {round(dose_to_isocenter*self.fractions,2)} Gy")
-            self.log(f"Reference point dose deviation: {round((dose_to_isocenter/self.dose)*100 - 100,2)}%")
+            scale = settings.reference_scale * (settings.reference_histories / settings.histories) / settings.reference_mus
+            data = merge_iso_files(natsorted(iso_files), [scale * float(mu) for mu in settings.sequence], progress=self.parent.progress)
+            self.parent.progress(0)
+            dose_to_isocenter, statistical_accuracy, average_counts = iso_summary(data)
+            self.log(f"Dose to reference point: {round(dose_to_isocenter*settings.fractions,2)} Gy")
+            self.log(f"Reference point dose deviation: {round((dose_to_isocenter/settings.dose)*100 - 100,2)}%")
             self.log(f"Statistical accuracy: {round(100*statistical_accuracy,2)}%")
-            self.log(f"Average counts in PTV: {int(np.average(count_in_bin))}")
-            with open(os.path.join(self.folder.get(), f"{self.descriptionentry.get().strip()}_iso.csv"), "w") as file:
-                np.savetxt(file, data, delimiter=",", header="Sum\tStandard_Deviation\tHistories_with_Scorer_Active\tCount_in_Bin\tMax", comments="", fmt='%1.4e\t%1.4e\t%1.0f\t%1.0f\t%1.4e') 
-            self.log(f"Saved merged isocenter file to {os.path.join(self.folder.get(), f'{self.descriptionentry.get().strip()}_iso.csv')}")
-            self.parent.pbvar.set(0)
+            self.log(f"Average counts in PTV: {int(average_counts)}")
+            iso_output = os.path.join(settings.folder, f"{description}_iso.csv")
+            write_iso_csv(iso_output, data)
+            self.log(f"Saved merged isocenter file to {iso_output}")
+            self.parent.progress(0)
             
-        if self.dvh.get():
-            self.structures.calculate_dvhs()
-            
-        if self.gamma.get():
-            self.calculate_gamma()
-        
-        self.log("Merging complete. Done!")
+        if settings.gamma is not None:
+            self.calculate_gamma(settings)
         
-    def read_iso_csv(self, f, scale):
-        
-        with open(f, "r") as file:
-            lines = file.readlines()[9:]
-            
-        data = []
-        for line in lines:
-            l = line.split(",")
-            data += [float(l[3])*scale, float(l[4])*scale, int(l[5]), int(l[6]), float(l[7])*scale]
-        return np.array(data).reshape(-1, 5)           
+        # The DVHs run last on their own executor; they finish the merge
+        # from the Tk thread once both DVH sets are written.
+        if settings.dvh:
+            return self.structures.calculate_dvhs(settings, done=self.merge_done) is not None
+        return False
         
     def init_tab2(self):
         ### TAB 2 ###
@@ -317,7 +386,7 @@ class Options(ctk.CTkTabview):
         
         self.rtplanlabel = ctk.CTkLabel(self.tab("RTPLAN"), text="Load MU sequence from RTPLAN", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
         self.rtplanlabel.grid(row=0, column=1, columnspan=4, sticky="nsew", padx=5, pady=(20,1))
-        self.rtplan_checkbox = ctk.CTkCheckBox(self.tab("RTPLAN"), text="", width=30, command=self.reveal_button)
+        self.rtplan_checkbox = ctk.CTkCheckBox(self.tab("RTPLAN"), text="", width=30, command=self.reveal_button, variable=ctk.BooleanVar(self, value=False))
         self.rtplan_checkbox.grid(row=0, column=0, sticky="nsew", padx=5, pady=(20,1))
         self.dicomimage = ctk.CTkImage(dark_image=Image.open(self.resource_path(os.path.join("src","images","dcm.ico"))), size=(40,24))
         self.rtplan_button = ctk.CTkButton(self.tab("RTPLAN"), image=self.dicomimage, compound="left", text="Load RTPLAN", width=30, command=self.load_mu_sequence)
@@ -332,6 +401,12 @@ class Options(ctk.CTkTabview):
         self.mergeisolabel.grid(row=1, column=1, columnspan=4, sticky="nsew", padx=5, pady=(20,1))
         self.mergeisocheckbox.grid(row=1, column=0, sticky="nsew", padx=5, pady=(20,1))
         
+        self.incrementallabel = ctk.CTkLabel(self.tab("RTPLAN"), text="Incremental re-merge of changed control points", font=("Bahnschrift",14), fg_color="#2B2B2B", anchor="w")
+        self.incremental = ctk.BooleanVar(self, value=False)
+        self.incrementalcheckbox = ctk.CTkCheckBox(self.tab("RTPLAN"), text="", width=30, variable = self.incremental)
+        self.incrementallabel.grid(row=3, column=1, columnspan=4, sticky="nsew", padx=5, pady=(20,1))
+        self.incrementalcheckbox.grid(row=3, column=0, sticky="nsew", padx=5, pady=(20,1))
+        
     def reveal_button(self):
         if self.rtplan_checkbox._check_state == True:
             self.rtplan_button.grid(row=2, column=1, sticky="nsw", padx=5, pady=(20,1))
@@ -351,56 +426,30 @@ class Options(ctk.CTkTabview):
         if self.mus_checkbox._check_state == True:
             self.rtplan_checkbox.deselect()
 
-    def string_to_seed(self, seed_string):
-        return int(hashlib.sha256(seed_string.encode()).hexdigest(), 16) % (2**32 - 1)
-
-    def random_interpolation_same_sum(self, list, seed_string):
-        np.random.seed(self.string_to_seed(seed_string))
-        new_list = []
-        for i in range(len(list) - 1):
-            if i == 0:
-                new_list.append(round(list[i] + (a:=np.random.random()) * (list[i+1] - list[i]),5))
-            else:
-                new_list.append(round(new_list[i-1] + (b:=np.random.random()) * (list[i+1] - new_list[i-1]),5))
-        new_list.append(round(list[-1],5))
-
-        return new_list
-        
     def load_mu_sequence(self):
         
         path = askopenfilename(filetypes=[("RTPLAN", "*.dcm")])
         if path != "":            
                  
-            plan = Plan(path)
             self.log(f"Loading MU sequence from {path}")
-            fxgroups = [var for var in plan.fx_group]
-            self.beams = [var.beam for var in fxgroups][0]
-            mu = [[] for i in range(len(self.beams))]
-            for j, beam in enumerate(self.beams):
-                for i, value in enumerate(beam.cum_mu):
-                    try:
-                        beam.cp_seq[i].BeamLimitingDevicePositionSequence
-                        mu[j].append(value)
-                    except AttributeError:
-                        pass
+            plan = read_plan(path)
+            self.beams = plan.beams
             seed_string = "42"
-            self.mu = mu.copy()
+            self.mu = plan.cumulative_mu.copy()
+            self.sequence = mu_sequence(plan.cumulative_mu, self.interpolate.get(), seed_string)
             if self.interpolate.get():
-                mu = [np.diff([0]+self.random_interpolation_same_sum(mu[i], seed_string)) for i in range(len(mu))]
                 self.log(f"Interpolated control points with seed {seed_string}!")
             else:
-                mu = [np.diff([0]+mu[i]) for i in range(len(mu))]
-
                 self.log("No control point interpolation applied!")
-            self.sequence = np.array([item for sublist in mu for item in sublist])
-            self.fractions = float(plan.summary[0]["Fractions"])
-            self.dose = sum([plan.rt_plan.FractionGroupSequence[0].ReferencedBeamSequence[i].BeamDose for i in range(len(self.beams))])
+            self.fractions = plan.fractions
+            self.dose = plan.dose
             self.log(f"Prescription: {self.fractions} x {round(self.dose,2)} Gy")
             self.log(f"Number of beams: {len(self.beams)}")
             self.log(f"Number of control points: {len(self.sequence)}")
             self.log(f"Total MU: {round(np.sum(self.sequence),3)}")
             self.scrollframe = MU_Sequence(self.tab("RTPLAN"), self.sequence)
             self.scrollframe.grid(row=5, column=1, columnspan=3, sticky="ew", padx=5, pady=(20,1))                              
+            self.check_buttons()
         else:
             self.log("No RTPLAN selected")
 
@@ -413,7 +462,7 @@ class Options(ctk.CTkTabview):
         self.scrollframe.destroy()
         if self.interpolate.get():
             seed_string = "42"
-            mu = [np.diff([0]+self.random_interpolation_same_sum(self.mu[i], seed_string)) for i in range(len(self.mu))]
+            mu = [np.diff([0]+random_interpolation_same_sum(self.mu[i], seed_string)) for i in range(len(self.mu))]
             self.log(f"Interpolated control points with seed {seed_string}!")
         else:
             mu = [np.roll(np.diff([0]+self.mu[i]),-1) for i in range(len(self.mu))]
@@ -421,6 +470,7 @@ class Options(ctk.CTkTabview):
         self.sequence = np.array([item for sublist in mu for item in sublist])
         self.scrollframe = MU_Sequence(self.tab("RTPLAN"), self.sequence)
         self.scrollframe.grid(row=5, column=1, columnspan=3, sticky="ew", padx=5, pady=(20,1))
+        self.check_buttons()
             
     def init_tab3(self):
         ### TAB 3 ###
@@ -438,14 +488,21 @@ class Options(ctk.CTkTabview):
         self.structures = StructureSelector(self.tab("DVH"))
         self.rtstruct_button = ctk.CTkButton(self.tab("DVH"), image=self.dicomimage, compound="left", text="Load RTSTRUCT", width=30, command=self.load_structures)
         self.rtdosebutton = ctk.CTkButton(self.tab("DVH"), image=self.dicomimage, compound="left", text="Load RTDOSE", width=30, command=self.load_dose)
+        self.dvh_workers = ctk.StringVar(value=str(DVH_WORKERS))
+        self.dvh_workers_label = ctk.CTkLabel(self.tab("DVH"), text="Worker Processes", font=("Bahnschrift",12), fg_color="#2B2B2B", anchor="e")
+        self.dvh_workers_entry = ctk.CTkEntry(self.tab("DVH"), width=60, textvariable=self.dvh_workers)
 
     def reveal_button2(self):
         if self.dvh_checkbox.get() == True:
             self.rtstruct_button.grid(row=1, column=1, sticky="nsw", padx=5, pady=(20,1))
             self.rtdosebutton.grid(row=1, column=2, sticky="nsw", padx=5, pady=(20,1))
+            self.dvh_workers_label.grid(row=3, column=1, sticky="e", padx=5, pady=(20,1))
+            self.dvh_workers_entry.grid(row=3, column=2, sticky="w", padx=5, pady=(20,1))
         else:
             self.rtstruct_button.grid_forget()
             self.rtdosebutton.grid_forget()
+            self.dvh_workers_label.grid_forget()
+            self.dvh_workers_entry.grid_forget()
             try: self.structures.grid_forget()
             except Exception: pass
         
@@ -485,59 +542,72 @@ class Options(ctk.CTkTabview):
         self.roi_selector.grid(row=1, column=2, sticky="w", padx=5, pady=(20,1))
         self.gammatype = ctk.CTkLabel(self.tab("Gamma"), text="Gamma Type", font=("Bahnschrift",12), fg_color="#2B2B2B")
         self.gammatype.grid(row=2, column=1, sticky="w", padx=5, pady=(20,1))
-        self.gammatypeselector = ctk.CTkComboBox(self.tab("Gamma"), width=100, values=["Global", "Local"])
+        self.gammatypeselector = ctk.CTkComboBox(self.tab("Gamma"), width=100, values=["Global", "Local", "Global + Local"])
         self.gammatypeselector.grid(row=2, column=2, sticky="w", padx=5, pady=(20,1))
-        self.dosecriteria = ctk.CTkLabel(self.tab("Gamma"), text="Dose Criteria [%]", font=("Bahnschrift",12), fg_color="#2B2B2B")
-        self.distancecriteria = ctk.CTkLabel(self.tab("Gamma"), text="Distance Criteria [mm]", font=("Bahnschrift",12), fg_color="#2B2B2B")
-        self.dosecriteria.grid(row=3, column=1, sticky="w", padx=5, pady=(20,1))
-        self.distancecriteria.grid(row=4, column=1, sticky="w", padx=5, pady=(20,1))
-        self.dosecriteria_entry = ctk.CTkEntry(self.tab("Gamma"), width=100)
-        self.dosecriteria_entry.insert(0, "2")
-        self.distancecriteria_entry = ctk.CTkEntry(self.tab("Gamma"), width=100)
-        self.distancecriteria_entry.insert(0, "3")
-        self.dosecriteria_entry.grid(row=3, column=2, sticky="w", padx=5, pady=(20,1))
-        self.distancecriteria_entry.grid(row=4, column=2, sticky="w", padx=5, pady=(20,1))
+        self.criteria = ctk.CTkLabel(self.tab("Gamma"), text="Criteria [%/mm]", font=("Bahnschrift",12), fg_color="#2B2B2B")
+        self.criteria.grid(row=3, column=1, sticky="w", padx=5, pady=(20,1))
+        self.criteria_entry = ctk.CTkEntry(self.tab("Gamma"), width=150)
+        self.criteria_entry.insert(0, "2/3")
+        self.criteria_entry.grid(row=3, column=2, sticky="w", padx=5, pady=(20,1))
         self.dosethreshold = ctk.CTkLabel(self.tab("Gamma"), text="Dose Threshold [%]", font=("Bahnschrift",12), fg_color="#2B2B2B")
-        self.dosethreshold.grid(row=5, column=1, sticky="w", padx=5, pady=(20,1))
+        self.dosethreshold.grid(row=4, column=1, sticky="w", padx=5, pady=(20,1))
         self.dosethreshold_entry = ctk.CTkEntry(self.tab("Gamma"), width=100)
         self.dosethreshold_entry.insert(0, "10")
-        self.dosethreshold_entry.grid(row=5, column=2, sticky="w", padx=5, pady=(20,1))
-        
-    def get_roi_number(self):
-        roi_number = [r[0] for r in self.structures.structures if r[1] == self.roi.get()][0]
-        return int(roi_number)
-        
-        
-    def calculate_gamma(self):       
-        ref_dose = self.rtdose
-        test_dose = os.path.join(self.folder.get(), f'{self.descriptionentry.get().strip()}.dcm')
-        roi = self.get_roi_number()
-        
-        self.log(f"Creating dose maps for selected structure: {self.roi.get()}")
-        axes_reference, dose_reference = crop_dose_to_roi(ref_dose, self.rtstruct, roi, self.parent.pbvar)
-        axes_evaluation, dose_evaluation = crop_dose_to_roi(test_dose, self.rtstruct, roi, self.parent.pbvar)
-        
-        gamma_options = {
-            'dose_percent_threshold': int(self.dosecriteria_entry.get()),
-            'distance_mm_threshold': int(self.distancecriteria_entry.get()),
-            'lower_percent_dose_cutoff': int(self.dosethreshold_entry.get()),
-            'interp_fraction': 10,  # Should be 10 or more for more accurate results
-            'max_gamma': 2,
-            'random_subset': None,
-            'local_gamma': True if self.gammatypeselector.get() == "Local" else False,
-            'ram_available': 2**32,
-            'quiet': True,
-        }
-        self.log(f"Calculating {self.dosecriteria_entry.get()}%/{self.distancecriteria_entry.get()}mm Gamma Passrate for structure {self.roi.get()} ...")
-        gam = gamma(
-            axes_reference,
-            dose_reference,
-            axes_evaluation,
-            dose_evaluation,
-            self.parent.pbvar,
-            **gamma_options
+        self.dosethreshold_entry.grid(row=4, column=2, sticky="w", padx=5, pady=(20,1))
+        self.gamma_workers_label = ctk.CTkLabel(self.tab("Gamma"), text="Threads", font=("Bahnschrift",12), fg_color="#2B2B2B")
+        self.gamma_workers_label.grid(row=5, column=1, sticky="w", padx=5, pady=(20,1))
+        self.gamma_workers = ctk.StringVar(value=str(os.cpu_count() or 1))
+        self.gamma_workers_entry = ctk.CTkEntry(self.tab("Gamma"), width=100, textvariable=self.gamma_workers)
+        self.gamma_workers_entry.grid(row=5, column=2, sticky="w", padx=5, pady=(20,1))
+        
+    def gamma_settings(self):
+        """Read the Gamma tab into a GammaSettings."""
+        from .gamma import parse_criteria
+
+        roi_numbers = [r[0] for r in getattr(self.structures, "structures", []) if r[1] == self.roi.get()]
+        if len(roi_numbers) == 0:
+            raise ValueError("No region of interest selected for the gamma calculation")
+        try:
+            workers = max(1, int(self.gamma_workers.get()))
+        except ValueError:
+            workers = 1
+            self.log("Invalid number of threads, calculating gamma with a single thread")
+        try:
+            criteria = parse_criteria(self.criteria_entry.get())
+        except ValueError:
+            raise ValueError("Invalid gamma criteria, expected e.g. 3/3, 2/2")
+        try:
+            lower_percent_dose_cutoff = int(self.dosethreshold_entry.get())
+        except ValueError:
+            raise ValueError("Invalid gamma dose threshold")
+        gamma_type = self.gammatypeselector.get()
+        return GammaSettings(
+            roi_number=int(roi_numbers[0]),
+            roi_name=self.roi.get(),
+            criteria=criteria,
+            criteria_text=self.criteria_entry.get(),
+            gamma_types=["Global", "Local"] if gamma_type == "Global + Local" else [gamma_type],
+            lower_percent_dose_cutoff=lower_percent_dose_cutoff,
+            workers=workers,
+        )
+        
+    def calculate_gamma(self, settings):       
+        from .gamma import gamma_pass_rates
+
+        gamma = settings.gamma
+        test_dose = os.path.join(settings.folder, f'{settings.description.strip()}.dcm')
+        self.log(f"Calculating {gamma.criteria_text} Gamma Passrates for structure {gamma.roi_name} ...")
+        pass_ratios = gamma_pass_rates(
+            settings.rtdose,
+            test_dose,
+            settings.rtstruct,
+            gamma.roi_number,
+            gamma.criteria,
+            gamma.gamma_types,
+            lower_percent_dose_cutoff=gamma.lower_percent_dose_cutoff,
+            progress=self.parent.progress,
+            workers=gamma.workers,
         )
-        valid_gamma = gam[~np.isnan(gam)]
-        pass_ratio = np.sum(valid_gamma <= 1) / len(valid_gamma)
-        self.log(f"Gamma Passrate: {round(pass_ratio*100,2)} %")
-        self.parent.pbvar.set(0)
\ No newline at end of file
+        for (dose, distance, gamma_type), pass_ratio in pass_ratios.items():
+            self.log(f"{gamma_type} {dose:g}%/{distance:g}mm Gamma Passrate: {round(pass_ratio*100,2)} %")
+        self.parent.progress(0)
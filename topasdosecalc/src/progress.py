@@ -0,0 +1,137 @@
+import json
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+PROGRESS_RATE = 10  # updates per second
+
+
+class ProgressChannel:
+    """Progress and log messages posted by worker threads.
+
+    Posting never blocks: ``progress`` only stores the latest fraction, so
+    updates in between two reads are coalesced, and ``log`` appends to a
+    deque. The consumer is woken through ``wake`` when the first update
+    after a read arrives and reads the channel at most ``rate`` times per
+    second, so a calculation reporting every step costs an attribute store.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Maximum number of reads per second.
+    wake : callable, optional
+        Called from the posting thread to tell the consumer that there are
+        new updates. It is not called again until the consumer resumes.
+    """
+
+    def __init__(self, rate=PROGRESS_RATE, wake=None):
+        self.interval = 1 / rate
+        self.wake = wake
+        self.fraction = 0.0
+        self.read_fraction = 0.0
+        self.messages = deque()
+        self.waiting = False
+
+    def progress(self, fraction):
+        self.fraction = fraction
+        self.notify()
+
+    def log(self, message, logtime=True):
+        self.messages.append((datetime.now(), message, logtime))
+        self.notify()
+
+    def notify(self):
+        if not self.waiting and self.wake is not None:
+            self.waiting = True
+            self.wake()
+
+    def read(self):
+        """Return the latest fraction and the messages posted since the last
+        read as (time, message, logtime) tuples."""
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.popleft())
+            except IndexError:
+                break
+        self.read_fraction = self.fraction
+        return self.read_fraction, messages
+
+    def resume(self):
+        """Allow the consumer to be woken again. Returns True if updates
+        arrived since the last read, which the consumer should then read."""
+        self.waiting = False
+        if self.messages or self.fraction != self.read_fraction:
+            self.waiting = True
+            return True
+        return False
+
+
+class TkProgress:
+    """Reads a ProgressChannel on the Tk main loop.
+
+    The channel wakes the main loop with a ``<<Progress>>`` virtual event;
+    after each read the consumer waits for the channel interval before it
+    can be woken again, so the widgets are updated at most ``rate`` times
+    per second and the main loop is idle while nothing is posted.
+    """
+
+    def __init__(self, widget, channel, set_progress, write_log):
+        self.widget = widget
+        self.channel = channel
+        self.set_progress = set_progress
+        self.write_log = write_log
+        widget.bind("<<Progress>>", self.update)
+        channel.wake = lambda: widget.event_generate("<<Progress>>", when="tail")
+
+    def update(self, event=None):
+        fraction, messages = self.channel.read()
+        for moment, message, logtime in messages:
+            self.write_log(moment, message, logtime)
+        self.set_progress(fraction)
+        self.widget.after(int(self.channel.interval * 1000), self.resume)
+
+    def resume(self):
+        if self.channel.resume():
+            self.update()
+
+
+class JsonLinesLog:
+    """Structured log of a headless run with one JSON object per line.
+
+    Log messages are written as ``{"time", "event": "log", "message"}`` and
+    progress as ``{"time", "event": "progress", "stage", "fraction"}``,
+    where the stage is the last logged message. Progress is written at most
+    ``rate`` times per second, and always for fractions of 0 and 1, which
+    mark the start and end of a stage.
+    """
+
+    def __init__(self, path, rate=PROGRESS_RATE):
+        self.path = path
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+        self.stage = None
+        self.last = 0.0
+
+    def write(self, entry):
+        entry = dict(time=datetime.now().isoformat(timespec="milliseconds"), **entry)
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def log(self, message, logtime=True):
+        self.stage = message
+        self.write({"event": "log", "message": message})
+
+    def progress(self, fraction):
+        now = time.monotonic()
+        if now - self.last < self.interval and 0 < fraction < 1:
+            return
+        self.last = now
+        self.write({"event": "progress", "stage": self.stage, "fraction": float(fraction)})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
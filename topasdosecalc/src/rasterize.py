@@ -0,0 +1,174 @@
+import numpy as np
+
+RASTER_BLOCK = 2**22  # rows x edges tested at once
+SIGNED_DISTANCE_LIMIT = 1e6  # mm, distance to the edge of an empty mask
+PLANE_TOLERANCE = 1e-3  # mm
+
+
+def contour_edges(contours):
+    """Return the (x1, y1, x2, y2) arrays of the closed edges of every
+    contour, a list of (x, y) point sequences."""
+    edges = []
+    for contour in contours:
+        points = np.asarray(contour, dtype=float)
+        if len(points) < 3:
+            continue
+        points = points[:, :2]
+        edges.append(np.hstack([points, np.roll(points, -1, axis=0)]))
+    if not edges:
+        return np.empty((4, 0))
+    return np.concatenate(edges).T
+
+
+def contours_mask(contours, x_axis, y_axis):
+    """Rasterise contours onto a grid with the even-odd rule.
+
+    A grid point is inside if a ray from it crosses the edges of all
+    contours an odd number of times, so a contour inside another one cuts
+    a hole, as the XOR of the single contour masks would. Only the rows
+    within the bounding box of the contours are scanned; for each of them
+    the crossings of every edge are found at once and the columns between
+    pairs of crossings are filled.
+
+    Parameters
+    ----------
+    contours : list
+        Contours as sequences of (x, y) points, further columns such as z
+        are ignored.
+    x_axis, y_axis : np.ndarray
+        Coordinates of the grid columns and rows, ascending or descending.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of shape (len(y_axis), len(x_axis)).
+    """
+    x_axis = np.asarray(x_axis, dtype=float)
+    y_axis = np.asarray(y_axis, dtype=float)
+    mask = np.zeros((len(y_axis), len(x_axis)), dtype=bool)
+    x1, y1, x2, y2 = contour_edges(contours)
+    if not len(x1) or not len(x_axis):
+        return mask
+
+    rows = np.flatnonzero((y_axis >= min(y1.min(), y2.min())) & (y_axis <= max(y1.max(), y2.max())))
+    if not len(rows):
+        return mask
+    descending = len(x_axis) > 1 and x_axis[0] > x_axis[-1]
+    ascending_x = x_axis[::-1] if descending else x_axis
+    rows_per_block = max(1, RASTER_BLOCK // len(x1))
+    for start in range(0, len(rows), rows_per_block):
+        block = rows[start:start + rows_per_block]
+        inside = scan_rows(x1, y1, x2, y2, y_axis[block], ascending_x)
+        mask[block] = inside[:, ::-1] if descending else inside
+    return mask
+
+
+def scan_rows(x1, y1, x2, y2, y, x_axis):
+    """Even-odd fill of the rows at ``y`` on the ascending ``x_axis``."""
+    y = y[:, None]
+
+    # Half-open rule: an edge crosses the row if exactly one end is at or
+    # above it, so vertices on a row are counted once and horizontal edges
+    # never.
+    crossing = (y1 >= y) != (y2 >= y)
+    row, edge = np.nonzero(crossing)
+    ty = y[row, 0]
+    x1, y1, x2, y2 = x1[edge], y1[edge], x2[edge], y2[edge]
+
+    # A point is inside if an odd number of crossings lie right of it. The
+    # columns a crossing toggles are found from its position, then the two
+    # columns next to it are decided exactly as matplotlib's
+    # Path.contains_points does, so points on an edge agree with it.
+    def toggled(column):
+        tx = x_axis[np.clip(column, 0, len(x_axis) - 1)]
+        return ((y2 - ty) * (x1 - x2) >= (x2 - tx) * (y1 - y2)) == (y2 >= ty)
+
+    x = x1 + (ty - y1) * (x2 - x1) / (y2 - y1)
+    column = np.searchsorted(x_axis, x)
+    column += (column < len(x_axis)) & toggled(column)
+    column -= (column > 0) & ~toggled(column - 1)
+
+    # Each crossing toggles every column left of ``column``, which a
+    # cumulative sum from the right gives for all columns at once.
+    toggles = np.zeros((len(y), len(x_axis) + 1), dtype=np.int32)
+    np.add.at(toggles, (row, column), 1)
+    return (np.cumsum(toggles[:, :0:-1], axis=1)[:, ::-1] & 1).astype(bool)
+
+
+def signed_distance(mask, sampling):
+    """Signed distance of every grid point to the edge of ``mask``, negative
+    inside. Empty and full masks give a large positive or negative value."""
+    from scipy.ndimage import distance_transform_edt
+
+    if not mask.any():
+        return np.full(mask.shape, SIGNED_DISTANCE_LIMIT)
+    if mask.all():
+        return np.full(mask.shape, -SIGNED_DISTANCE_LIMIT)
+    return distance_transform_edt(~mask, sampling=sampling) - distance_transform_edt(mask, sampling=sampling)
+
+
+def interpolate_masks(z, masks, new_z, sampling=None):
+    """Shape-based interpolation of the masks of a structure between planes.
+
+    Every plane mask is turned into a signed distance map once; the mask of
+    a plane in between two planes is where the linear blend of their two
+    maps is negative. All new planes are blended in one vectorized step.
+    Planes outside the range of ``z`` take the mask of the nearest plane.
+
+    Parameters
+    ----------
+    z : np.ndarray
+        Ascending positions of the planes of ``masks``.
+    masks : np.ndarray
+        Boolean (planes, rows, columns) masks.
+    new_z : np.ndarray
+        Positions of the interpolated planes.
+    sampling : tuple, optional
+        Row and column spacing of the masks.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean (len(new_z), rows, columns) masks.
+    """
+    z = np.asarray(z, dtype=float)
+    new_z = np.asarray(new_z, dtype=float)
+    masks = np.asarray(masks, dtype=bool)
+    if len(z) == 1:
+        return np.repeat(masks, len(new_z), axis=0)
+
+    distances = np.array([signed_distance(mask, sampling) for mask in masks], dtype=np.float32)
+    lower = np.clip(np.searchsorted(z, new_z, side="right") - 1, 0, len(z) - 2)
+    fraction = np.clip((new_z - z[lower]) / (z[lower + 1] - z[lower]), 0, 1).astype(np.float32)[:, None, None]
+    blended = distances[lower] * (1 - fraction) + distances[lower + 1] * fraction
+
+    # Planes that coincide with a contour plane keep its rasterised mask
+    exact = np.isclose(new_z[:, None], z[None, :], rtol=0, atol=PLANE_TOLERANCE)
+    result = blended < 0
+    rows, planes = np.nonzero(exact)
+    result[rows] = masks[planes]
+    return result
+
+
+def structure_bounding_box(planes, lut, margin=None):
+    """Return the column and row slices of the dose grid ``lut`` that hold
+    every contour point of ``planes`` plus ``margin`` mm.
+
+    With a margin of None, or if no grid point lies in the box, the whole
+    grid is returned.
+    """
+    whole = (slice(0, len(lut[0])), slice(0, len(lut[1])))
+    if margin is None or not np.isfinite(margin):
+        return whole
+    points = np.concatenate(
+        [np.asarray(contour['data'], dtype=float)[:, :2] for plane in planes.values() for contour in plane]
+    )
+    lower = points.min(axis=0) - margin
+    upper = points.max(axis=0) + margin
+    box = []
+    for i, axis in enumerate(lut):
+        inside = np.flatnonzero((axis >= lower[i]) & (axis <= upper[i]))
+        if not len(inside):
+            return whole
+        box.append(slice(inside[0], inside[-1] + 1))
+    return tuple(box)
@@ -0,0 +1,60 @@
+import hashlib
+import numpy as np
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(frozen=True)
+class PlanData:
+    beams: Any
+    cumulative_mu: list
+    fractions: float
+    dose: float
+
+
+def read_plan(path):
+    """Read the beams, the cumulative MU of every control point with MLC
+    positions, the number of fractions and the prescribed dose per fraction
+    from an RTPLAN file."""
+    from mlca.mlc_analyzer import Plan
+
+    plan = Plan(path)
+    fxgroups = [var for var in plan.fx_group]
+    beams = [var.beam for var in fxgroups][0]
+    mu = [[] for i in range(len(beams))]
+    for j, beam in enumerate(beams):
+        for i, value in enumerate(beam.cum_mu):
+            try:
+                beam.cp_seq[i].BeamLimitingDevicePositionSequence
+                mu[j].append(value)
+            except AttributeError:
+                pass
+    fractions = float(plan.summary[0]["Fractions"])
+    dose = sum([plan.rt_plan.FractionGroupSequence[0].ReferencedBeamSequence[i].BeamDose for i in range(len(beams))])
+    return PlanData(beams, mu, fractions, dose)
+
+
+def mu_sequence(cumulative_mu, interpolate=False, seed_string="42"):
+    """Return the MU of every control point of all beams as a flat array."""
+    if interpolate:
+        mu = [np.diff([0]+random_interpolation_same_sum(cumulative_mu[i], seed_string)) for i in range(len(cumulative_mu))]
+    else:
+        mu = [np.diff([0]+cumulative_mu[i]) for i in range(len(cumulative_mu))]
+    return np.array([item for sublist in mu for item in sublist])
+
+
+def string_to_seed(seed_string):
+    return int(hashlib.sha256(seed_string.encode()).hexdigest(), 16) % (2**32 - 1)
+
+
+def random_interpolation_same_sum(list, seed_string):
+    np.random.seed(string_to_seed(seed_string))
+    new_list = []
+    for i in range(len(list) - 1):
+        if i == 0:
+            new_list.append(round(list[i] + (a:=np.random.random()) * (list[i+1] - list[i]),5))
+        else:
+            new_list.append(round(new_list[i-1] + (b:=np.random.random()) * (list[i+1] - new_list[i-1]),5))
+    new_list.append(round(list[-1],5))
+
+    return new_list
@@ -0,0 +1,63 @@
+import numpy as np
+from .disk_cache import DiskCache
+
+SHELL_CACHE_SIZE = 512
+SHELL_QUANTUM = 1e-6  # mm
+
+
+class ShellCache(DiskCache):
+    """LRU cache of the coordinate shells searched by the gamma calculation.
+
+    A shell only depends on the distance, the step size between its points
+    and the number of dimensions, so it is the same for every reference
+    point, every gamma run and every patient evaluated with the same
+    criteria. Distances and step sizes are quantized to ``SHELL_QUANTUM`` for
+    the key. If ``directory`` is given, shells are also stored there as
+    ``.npy`` files and read back instead of being generated again.
+    """
+
+    def __init__(self, maxsize=SHELL_CACHE_SIZE, directory=None):
+        super().__init__(maxsize, directory)
+
+    @staticmethod
+    def key(distance, num_dimensions, distance_step_size):
+        return (
+            int(num_dimensions),
+            int(round(float(distance) / SHELL_QUANTUM)),
+            int(round(float(distance_step_size) / SHELL_QUANTUM)),
+        )
+
+    def get(self, distance, num_dimensions, distance_step_size):
+        """Return the shell as a read-only (num_dimensions, points) array."""
+        key = self.key(distance, num_dimensions, distance_step_size)
+        return self.lookup(key, lambda: generate_shell(key[1] * SHELL_QUANTUM, key[0], key[2] * SHELL_QUANTUM))
+
+    def filename(self, key):
+        return "shell_{}d_{}_{}.npy".format(*key)
+
+    def read(self, path, key):
+        shell = np.load(path)
+        if shell.ndim != 2 or shell.shape[0] != key[0]:
+            return None
+        return shell
+
+    def write(self, file, shell):
+        np.save(file, shell)
+
+
+def generate_shell(distance, num_dimensions, distance_step_size):
+    """Create the shell of coordinate shifts for the given testing distance."""
+    from pymedphys._utilities.createshells import calculate_coordinates_shell
+
+    return np.array(calculate_coordinates_shell(distance, num_dimensions, distance_step_size), dtype=np.float64)
+
+
+SHELL_CACHE = ShellCache()
+
+
+def calculate_coordinates_shell(distance, num_dimensions, distance_step_size, cache=None):
+    """Return the shell for the given testing distance from ``cache``, or
+    from the shared module cache if None."""
+    if cache is None:
+        cache = SHELL_CACHE
+    return cache.get(distance, num_dimensions, distance_step_size)
@@ -1,14 +1,9 @@
 import os
-import threading
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 import customtkinter as ctk
 
-import dicompylercore.dvhcalc as dv
-import matplotlib as mpl
-
-mpl.use("Agg")
-import matplotlib.pyplot as plt
-from pydicom import dcmread
+from .dvh import read_structures, calculate_dvh_sets, plot_dvhs
 
 
 class StructureSelector(ctk.CTkScrollableFrame):
@@ -16,6 +11,7 @@ class StructureSelector(ctk.CTkScrollableFrame):
 
         super().__init__(parent, orientation = "vertical")
         self.parent = parent
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
 
     def _bound_to_mousewheel(self, event):
@@ -33,19 +29,7 @@ class StructureSelector(ctk.CTkScrollableFrame):
 
     def create_buttons(self):
 
-        self.structures = []
-        with dcmread(self.parent.master.rtstruct) as dcmfile:
-            self.rtstruct = dcmfile
-            for i in range(len(dcmfile.StructureSetROISequence)):
-
-                self.structures += [
-                    (
-                        dcmfile.StructureSetROISequence[i].ROINumber,
-                        dcmfile.StructureSetROISequence[i].ROIName,
-                        "#"+"".join([format(c,'02x') for c in [dcmfile.ROIContourSequence[j].ROIDisplayColor for j in range(len(dcmfile.ROIContourSequence)) if dcmfile.ROIContourSequence[j].ReferencedROINumber == dcmfile.StructureSetROISequence[i].ROINumber][0]]),
-                    )
-                ]
-        self.structures.sort(key=lambda y: y[0])
+        self.rtstruct, self.structures = read_structures(self.parent.master.rtstruct)
         self.variables = [ctk.BooleanVar() for i in range(len(self.structures))]
         [variable.set(False) for variable in self.variables]
         self.buttons = [
@@ -72,118 +56,55 @@ class StructureSelector(ctk.CTkScrollableFrame):
                 "(ERROR) No or invalid RTSTRUCT file in reference DICOM folder!"
             )
 
-    def calculate_dvhs(self):
-        def calculate_TOPAS_DVHs():
-            dvh = []
-            filename = os.path.join(self.parent.master.folder.get(), f'{self.parent.master.descriptionentry.get().strip()}.dcm')
-
-            while True:
-                if os.path.exists(filename):
-                    k=1
-                    for i in range(len(self.structures)):
-                        if self.variables[i].get() == True:
-                            self.parent.master.log(
-                                f"Calculating TOPAS DVH for structure {self.structures[i][1]} ..."
-                            )
-                            self.parent.master.parent.pbvar.set((k)/len(
-                                [
-                                    variable
-                                    for variable in self.variables
-                                    if variable.get() == True
-                                ]
-                            ))
-                            dvh += [
-                                dv.get_dvh(
-                                    self.rtstruct,
-                                    filename,
-                                    self.structures[i][0],
-                                    limit=int(self.parent.master.fractions*self.parent.master.dose*110),
-                                )
-                            ]
-                            k+=1
-
-                if len(dvh) == len([x for x in self.variables if x.get() == True]):
-                    break
-            self.parent.master.parent.pbvar.set(0)
-            self.topas_dvh = dvh
-
-        def calculate_Reference_DVHs():
-            dvh = []
-            k = 1
-            for i in range(len(self.structures)):
-                if self.variables[i].get() == True:
-                    self.parent.master.log(
-                        f"Calculating Reference DVH for structure {self.structures[i][1]} ..."
-                    )
-                    self.parent.master.parent.pbvar.set((k)/len(
-                        [
-                            variable
-                            for variable in self.variables
-                            if variable.get() == True
-                        ]
-                    ))
-                    k+=1
-                    dvh += [
-                        dv.get_dvh(
-                            self.rtstruct,
-                            f"{self.parent.master.rtdose}",
-                            self.structures[i][0],
-                            limit=int(self.parent.master.fractions*self.parent.master.dose*110),
-                        )
-                    ]
-
-            self.parent.master.parent.pbvar.set(0)
-            self.ref_dvh = dvh
-
-        threading.Thread(calculate_TOPAS_DVHs()).start()
-        threading.Thread(calculate_Reference_DVHs()).start()
-        while True:
-            try:
-                if self.ref_dvh:
-                    pass
-                if self.topas_dvh:
-                    pass
-
-                for i in range(len(self.ref_dvh)):
-                    plt.plot(
-                        self.topas_dvh[i].bincenters,
-                        self.topas_dvh[i].relative_volume.counts,
-                        label=self.topas_dvh[i].name + " - TOPAS",
-                        color=self.structures[[self.structures[j][1] for j in range(len(self.structures))].index(self.topas_dvh[i].name)][2],
-                        linestyle="--",
-                        linewidth=0.5,
-                    )
-
-                    plt.plot(
-                        self.ref_dvh[i].bincenters,
-                        self.ref_dvh[i].relative_volume.counts,
-                        label=self.ref_dvh[i].name + " - Ref",
-                        color=self.structures[[self.structures[j][1] for j in range(len(self.structures))].index(self.ref_dvh[i].name)][2],
-                        linewidth=0.5,
-                    )
-
-                break
-
-            except Exception as e:
-                print(e)
-        if len(self.ref_dvh) != 0:
-            plt.xlabel("Dosis [%s]" % self.ref_dvh[0].dose_units)
-            plt.ylabel("Volumen [%s]" % self.ref_dvh[0].relative_volume.volume_units)
-            plt.xlim(
-                left=0,
-                right=self.parent.master.fractions*self.parent.master.dose*1.1)
-            self.parent.master.log(
-                f"Saving DVH.png to {self.parent.master.folder.get()}"
-            )
-            plt.grid()
-            plt.gcf().legend(bbox_to_anchor=(0.5,-0.05), loc="upper center", ncols=5, fancybox=True, shadow=True, prop={'size': 8})
-            plt.gcf().tight_layout()
-            plt.savefig(
-                os.path.join(self.parent.master.folder.get(), f'{self.parent.master.descriptionentry.get().strip()}.png'), dpi=600, bbox_inches='tight'
+    def selected_structures(self):
+        """The structures whose checkbox is selected, read on the Tk thread."""
+        return [self.structures[i] for i in range(len(self.structures)) if self.variables[i].get() == True]
+
+    def calculate_dvhs(self, settings, done=None):
+        """Calculate the DVHs of the merged dose described by ``settings``.
+
+        ``done`` is called on the Tk thread with True once the DVHs are
+        saved, or with False if they failed. Returns the future of the
+        calculation, or None if it could not be started.
+        """
+        limit = int(settings.fractions*settings.dose*110)
+        description = settings.description.strip()
+        filename = os.path.join(settings.folder, f"{description}.dcm")
+        if not os.path.exists(filename):
+            self.parent.master.log(f"(ERROR) Merged dose file {filename} not found, cannot calculate DVHs")
+            return None
+        dose_files = {"TOPAS DVH": filename, "Reference DVH": settings.rtdose}
+        path = os.path.join(settings.folder, f"{description}.png")
+        xmax = settings.fractions*settings.dose*1.1
+
+        def run():
+            dvhs = calculate_dvh_sets(
+                settings.rtstruct,
+                dose_files,
+                settings.selected_structures,
+                limit,
+                workers=settings.dvh_workers,
+                progress=self.parent.master.parent.progress,
+                log=self.parent.master.log,
             )
-
-
-            self.parent.master.parent.pbvar.set(0)
+            self.topas_dvh = dvhs["TOPAS DVH"]
+            self.ref_dvh = dvhs["Reference DVH"]
+            if len(self.ref_dvh) != 0:
+                self.parent.master.log(f"Saving DVH.png to {settings.folder}")
+                plot_dvhs(self.topas_dvh, self.ref_dvh, settings.structures, xmax, path)
+
+        # Both DVH sets are calculated by a process pool driven from a
+        # background thread; the result is handed back to the Tk thread.
+        future = self.executor.submit(run)
+        future.add_done_callback(lambda future: self.parent.master.parent.post(self.dvhs_done, future, done))
+        return future
+
+    def dvhs_done(self, future, done=None):
+        self.parent.master.parent.progress(0)
+        error = future.exception()
+        if error is not None:
+            self.parent.master.log(f"(ERROR) DVH calculation failed: {error}")
+        else:
             self.parent.master.log(f"Completed DVH calculation")
-        return
-
+        if done is not None:
+            done(error is None)